@@ -5,6 +5,13 @@ from flask_wtf.csrf import CSRFProtect
 from config import Config
 from .models import db, User
 from .routes import main
+from .commands import register_commands
+from .view_counter import view_counter
+from .image_pipeline import image_pipeline
+from .cache import fragment_cache
+from .notifications import notification_queue
+from .events import event_hub
+from .utils import upload_url, webp_source
 
 # 初始化登录管理器
 login_manager = LoginManager()
@@ -47,23 +54,31 @@ def create_app(config_class=Config):
     db.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
+    view_counter.init_app(app)
+    image_pipeline.init_app(app)
+    fragment_cache.init_app(app)
+    notification_queue.init_app(app)
+    event_hub.init_app(app)
     
     # 注册蓝图
     app.register_blueprint(main)
     
+    # 模板中通过upload_url获取上传图片地址，通过webp_source生成WebP候选
+    app.jinja_env.globals['upload_url'] = upload_url
+    app.jinja_env.globals['webp_source'] = webp_source
+    
+    # 注册命令行维护命令
+    register_commands(app)
+    
     # 添加全局上下文处理器，用于传递未读通知和消息数量
+    # 未读数由写入通知和私信的代码同步维护在User上，这里不再查询数据库
     @app.context_processor
     def inject_unread_counts():
-        from .models import Notification, Message
         from flask_login import current_user
         if current_user.is_authenticated:
-            # 获取未读通知数量
-            unread_notifications = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
-            # 获取未读消息数量
-            unread_messages = Message.query.filter_by(receiver_id=current_user.id, is_read=False).count()
             return {
-                'unread_notifications': unread_notifications,
-                'unread_messages': unread_messages
+                'unread_notifications': current_user.unread_notification_count,
+                'unread_messages': current_user.unread_message_count
             }
         return {
             'unread_notifications': 0,
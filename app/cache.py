@@ -0,0 +1,182 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+class MemoryBackend:
+    """进程内LRU缓存，超过容量时淘汰最久未使用的条目"""
+
+    def __init__(self, app):
+        self.max_entries = app.config.get('FRAGMENT_CACHE_SIZE', 500)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl if ttl else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class FileSystemBackend:
+    """
+    文件缓存，同一台服务器上的多个工作进程共享
+
+    每个条目一个文件，首行为过期时间；写入临时文件后原子替换。
+    """
+
+    # 每写入多少次清理一次过期文件
+    PRUNE_INTERVAL = 200
+
+    def __init__(self, app):
+        self.directory = app.config.get('FRAGMENT_CACHE_DIR') or os.path.join(app.instance_path, 'fragment_cache')
+        os.makedirs(self.directory, exist_ok=True)
+        self._writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                expires = float(f.readline())
+                if expires and expires < time.time():
+                    return None
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value, ttl=None):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(f'{time.time() + ttl if ttl else 0}\n')
+            f.write(value)
+        os.replace(temp_path, self._path(key))
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL == 0:
+            self._prune()
+
+    def _prune(self):
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    expires = float(f.readline())
+                if expires and expires < now:
+                    os.remove(path)
+            except (OSError, ValueError):
+                continue
+
+
+class NullBackend:
+    """不缓存，用于关闭片段缓存"""
+
+    def __init__(self, app):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'filesystem': FileSystemBackend,
+    'none': NullBackend,
+}
+
+
+class FragmentCache:
+    """
+    渲染结果片段缓存
+
+    按命名空间和路由参数缓存渲染好的HTML片段。每个命名空间有一个版本戳，
+    数据变化时更新版本戳，旧版本的条目不再命中，等待过期或被淘汰。
+    后端由FRAGMENT_CACHE_BACKEND配置：memory为进程内LRU（版本戳也只在本进程
+    内生效，其他进程最多延迟FRAGMENT_CACHE_TTL秒），filesystem为多进程共享的
+    文件缓存。
+    """
+
+    def __init__(self, app=None):
+        self.backend = NullBackend(None)
+        self.ttl = 60
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        绑定应用并创建缓存后端
+
+        Args:
+            app: Flask应用实例
+        """
+        self.backend = BACKENDS[app.config.get('FRAGMENT_CACHE_BACKEND', 'memory')](app)
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', 60)
+        app.extensions['fragment_cache'] = self
+
+    def _version(self, namespace):
+        version = self.backend.get(f'{namespace}:version')
+        if version is None:
+            # 版本戳使用时间戳而不是计数，被淘汰后重新生成也不会与旧版本重复
+            version = self.bump(namespace)
+        return version
+
+    def bump(self, namespace):
+        """
+        更新命名空间的版本戳，使该命名空间下已缓存的片段全部失效
+
+        应在数据变化的事务提交之后调用，避免其他请求在提交前用旧数据重新缓存。
+
+        Args:
+            namespace: 命名空间，如market
+
+        Returns:
+            str: 新的版本戳
+        """
+        version = str(time.time_ns())
+        self.backend.set(f'{namespace}:version', version)
+        return version
+
+    def get_or_render(self, namespace, key_parts, render):
+        """
+        读取缓存的片段，未命中时调用render渲染并写入缓存
+
+        Args:
+            namespace: 命名空间
+            key_parts: 影响渲染结果的所有参数
+            render: 渲染片段的函数，返回HTML字符串
+
+        Returns:
+            Markup: 渲染好的HTML片段
+        """
+        key = f'{namespace}:{self._version(namespace)}:{key_parts!r}'
+        html = self.backend.get(key)
+        if html is None:
+            html = render()
+            self.backend.set(key, str(html), self.ttl)
+        return Markup(html)
+
+
+# 全局片段缓存，由app/__init__.py统一初始化
+fragment_cache = FragmentCache()
@@ -0,0 +1,197 @@
+import click
+from sqlalchemy import func, inspect, select
+
+from .models import db
+
+# 关系表在加唯一索引前允许自动删除重复行（保留最早的一条）
+DEDUPLICATE_TABLES = {'follow', 'like', 'reply_like', 'user_follow'}
+
+
+def _add_missing_columns():
+    """
+    为已存在的表补齐模型中新增的列
+
+    db.create_all()只会创建缺失的表，不会修改已存在的表结构，
+    因此新增的计数列等需要通过ALTER TABLE补充。
+
+    Returns:
+        list: 新增的列，格式为"表名.列名"
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = db.engine.dialect.identifier_preparer
+    added = []
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = f'ALTER TABLE {preparer.format_table(table)} ADD {preparer.quote(column.name)} {column_type}'
+                if column.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+                conn.exec_driver_sql(ddl)
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def _delete_duplicates(conn, table, columns):
+    """
+    删除在指定列上重复的行，只保留ID最小的一条
+
+    Returns:
+        int: 删除的行数
+    """
+    keep = select(func.min(table.c.id)).group_by(*columns)
+    return conn.execute(table.delete().where(table.c.id.not_in(keep))).rowcount
+
+
+def _create_missing_indexes():
+    """
+    为已存在的表创建模型中声明但数据库中缺失的索引
+
+    关系表上新增唯一索引前会先清理历史重复数据。
+
+    Returns:
+        list: 新建的索引名称
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.unique and table.name in DEDUPLICATE_TABLES:
+                    removed = _delete_duplicates(conn, table, index.columns)
+                    if removed:
+                        click.echo(f'已删除 {table.name} 中 {removed} 条重复记录')
+                index.create(conn)
+                created.append(index.name)
+    return created
+
+
+def register_commands(app):
+    """
+    注册命令行维护命令
+
+    Args:
+        app: Flask应用实例
+    """
+
+    @app.cli.command('db-upgrade')
+    def db_upgrade():
+        """创建缺失的表，并补齐新增的列和索引"""
+        db.create_all()
+        for column in _add_missing_columns():
+            click.echo(f'已添加列: {column}')
+        for index in _create_missing_indexes():
+            click.echo(f'已创建索引: {index}')
+        click.echo('数据库结构已更新，如有重复记录被删除请执行 reconcile-counters')
+
+    @app.cli.command('reconcile-counters')
+    def reconcile_counters():
+        """根据明细数据重新计算商品和用户的计数器"""
+        from .counters import reconcile_item_counters, reconcile_user_counters
+        count = reconcile_item_counters()
+        click.echo(f'已重新计算 {count} 个商品的计数器')
+        count = reconcile_user_counters()
+        click.echo(f'已重新计算 {count} 个用户的计数器')
+
+    @app.cli.command('rebuild-conversations')
+    def rebuild_conversations_command():
+        """根据私信记录重建会话摘要表"""
+        from .conversations import rebuild_conversations
+        count = rebuild_conversations()
+        click.echo(f'已重建 {count} 个会话')
+
+    @app.cli.command('rebuild-timelines')
+    def rebuild_timelines_command():
+        """根据关注关系和已发布的内容重建关注动态时间线"""
+        from .timelines import rebuild_timelines
+        count = rebuild_timelines()
+        click.echo(f'已写入 {count} 条时间线记录')
+
+    @app.cli.command('trim-timelines')
+    def trim_timelines_command():
+        """删除超出保留条数的旧时间线记录，可由定时任务周期执行"""
+        from .timelines import trim_timelines
+        count = trim_timelines(app.config['TIMELINE_MAX_LENGTH'])
+        click.echo(f'已删除 {count} 条旧时间线记录')
+
+    @app.cli.command('backfill-orders')
+    def backfill_orders_command():
+        """根据历史购买通知补录订单"""
+        from .purchases import backfill_orders
+        count = backfill_orders()
+        click.echo(f'已补录 {count} 个订单')
+
+    @app.cli.command('refresh-leaderboards')
+    def refresh_leaderboards_command():
+        """重新计算排行榜快照，可由定时任务周期执行"""
+        from .leaderboard import refresh_leaderboards
+        refresh_leaderboards(app.config['LEADERBOARD_SIZE'])
+        click.echo('排行榜已刷新')
+
+    @app.cli.command('refresh-recommendations')
+    def refresh_recommendations_command():
+        """根据关注和购买记录重新计算相似商品，可由定时任务周期执行"""
+        from .recommendations import refresh_recommendations
+        count = refresh_recommendations(app.config['RECOMMENDATION_TOP_K'],
+                                        app.config['RECOMMENDATION_MAX_USER_SIGNALS'],
+                                        app.config['RECOMMENDATION_PURCHASE_WEIGHT'])
+        click.echo(f'已写入 {count} 条相似商品记录')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """根据商品、求购和帖子重建搜索索引"""
+        from .search import rebuild_search_index
+        count = rebuild_search_index()
+        click.echo(f'已为 {count} 条内容建立搜索索引')
+
+    @app.cli.command('rebuild-match-index')
+    def rebuild_match_index_command():
+        """根据商品和求购重建求购匹配索引"""
+        from .matching import rebuild_match_index
+        count = rebuild_match_index()
+        click.echo(f'已为 {count} 条商品和求购建立匹配索引')
+
+    @app.cli.command('process-staged-images')
+    def process_staged_images_command():
+        """处理暂存目录中遗留的上传图片（进程意外退出后执行）"""
+        from .image_pipeline import image_pipeline
+        count = image_pipeline.process_staged()
+        click.echo(f'已处理 {count} 张图片')
+
+    @app.cli.command('generate-image-variants')
+    def generate_image_variants_command():
+        """为已上传的图片补齐缩略图、大图和WebP版本"""
+        from .image_pipeline import image_pipeline
+        count = image_pipeline.backfill_variants()
+        click.echo(f'已为 {count} 张图片生成缺失的版本')
+
+    @app.cli.command('reconcile-uploads')
+    def reconcile_uploads_command():
+        """根据各表的图片列重新计算上传图片的引用数（上线引用计数后执行一次）"""
+        from .uploads import reconcile_upload_refs
+        count = reconcile_upload_refs()
+        click.echo(f'已登记 {count} 张图片')
+
+    @app.cli.command('gc-uploads')
+    def gc_uploads_command():
+        """删除已无引用且超过保留期的上传图片，可由定时任务周期执行"""
+        from .uploads import collect_unreferenced_uploads
+        total = 0
+        while True:
+            count = collect_unreferenced_uploads(app.config['UPLOAD_GC_GRACE'])
+            if not count:
+                break
+            total += count
+        click.echo(f'已删除 {total} 张无引用的图片')
@@ -0,0 +1,164 @@
+from sqlalchemy import and_, case, func, insert, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from .models import db, Message, Conversation
+from .counters import bump_unread_counts
+from .events import event_hub
+
+
+def _touch_conversation(user_id, partner_id, message, unread_delta):
+    """
+    更新(用户, 对话方)的会话摘要，不存在时创建
+
+    并发的首条消息（双方同时给对方发信）由(user_id, partner_id)唯一索引拒绝重复插入，
+    改为更新已有摘要；较早的消息晚于较新的消息提交时只累加未读数，不把预览改回旧消息。
+
+    Args:
+        user_id: 会话所属用户ID
+        partner_id: 对话方用户ID
+        message: 最新一条消息
+        unread_delta: 未读数增量
+    """
+    if _update_conversation(user_id, partner_id, message, unread_delta):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(Conversation).values(
+                user_id=user_id,
+                partner_id=partner_id,
+                last_message_id=message.id,
+                last_date=message.date_sent,
+                unread_count=unread_delta
+            ))
+    except IntegrityError:
+        # 并发请求已创建该会话摘要
+        _update_conversation(user_id, partner_id, message, unread_delta)
+
+
+def _update_conversation(user_id, partner_id, message, unread_delta):
+    newer = or_(Conversation.last_date < message.date_sent,
+                and_(Conversation.last_date == message.date_sent, Conversation.last_message_id < message.id))
+    return Conversation.query.filter_by(user_id=user_id, partner_id=partner_id).update({
+        Conversation.last_message_id: case((newer, message.id), else_=Conversation.last_message_id),
+        Conversation.last_date: case((newer, message.date_sent), else_=Conversation.last_date),
+        Conversation.unread_count: Conversation.unread_count + unread_delta,
+    }, synchronize_session=False)
+
+
+def send_message(sender_id, receiver_id, content):
+    """
+    创建一条私信，并在同一事务中更新双方的会话摘要，提交后推送给接收者
+
+    不提交事务，由调用方提交。
+
+    Args:
+        sender_id: 发送者ID
+        receiver_id: 接收者ID
+        content: 消息内容
+
+    Returns:
+        Message: 新建的消息对象
+    """
+    message = Message(sender_id=sender_id, receiver_id=receiver_id, content=content)
+    db.session.add(message)
+    # 先写入消息以获得ID和发送时间
+    db.session.flush()
+    _touch_conversation(sender_id, receiver_id, message, 0)
+    _touch_conversation(receiver_id, sender_id, message, 1)
+    bump_unread_counts(receiver_id, messages=1)
+    # 事务提交后推送给接收者
+    event_hub.publish_after_commit(receiver_id, 'message', {
+        'id': message.id,
+        'sender_id': sender_id,
+        'content': content,
+        'date_sent': message.date_sent.isoformat(),
+    })
+    return message
+
+
+def mark_thread_read(user_id, partner_id):
+    """
+    将对话方发给用户的未读消息全部标记为已读，并同步未读数
+
+    消息以一条UPDATE批量标记，会话未读数清零，用户的未读私信总数按实际标记的
+    条数扣减，无论积压多少未读消息都只执行这三条语句。
+    不提交事务，由调用方提交。
+
+    Args:
+        user_id: 会话所属用户ID
+        partner_id: 对话方用户ID
+
+    Returns:
+        int: 标记为已读的消息数量
+    """
+    count = Message.query.filter_by(receiver_id=user_id, sender_id=partner_id, is_read=False).update(
+        {Message.is_read: True}, synchronize_session=False
+    )
+    if count:
+        Conversation.query.filter_by(user_id=user_id, partner_id=partner_id).update(
+            {Conversation.unread_count: 0}, synchronize_session=False
+        )
+        bump_unread_counts(user_id, messages=-count)
+    return count
+
+
+def thread_condition(user_id, partner_id):
+    """返回两个用户之间聊天记录的过滤条件"""
+    return (((Message.sender_id == user_id) & (Message.receiver_id == partner_id)) |
+            ((Message.sender_id == partner_id) & (Message.receiver_id == user_id)))
+
+
+def get_conversations(user_id, page, per_page=30):
+    """
+    分页获取用户的会话列表，按最近消息时间倒序
+
+    Args:
+        user_id: 用户ID
+        page: 页码
+        per_page: 每页会话数量
+
+    Returns:
+        Pagination: 会话分页对象，对话方用户已一并加载
+    """
+    query = (Conversation.query
+             .filter_by(user_id=user_id)
+             .options(joinedload(Conversation.partner))
+             .order_by(Conversation.last_date.desc(), Conversation.id.desc()))
+    return query.paginate(page=page, per_page=per_page, error_out=False)
+
+
+def rebuild_conversations():
+    """
+    根据消息表批量重建所有会话摘要
+
+    用于上线会话表时回填历史数据，以及修复摘要与消息表的偏差。
+
+    Returns:
+        int: 重建的会话数量
+    """
+    rows = db.session.query(
+        Message.sender_id,
+        Message.receiver_id,
+        func.max(Message.id),
+        func.max(Message.date_sent),
+        func.sum(case((Message.is_read == False, 1), else_=0))  # noqa: E712
+    ).group_by(Message.sender_id, Message.receiver_id).all()
+
+    summaries = {}
+    for sender_id, receiver_id, last_id, last_date, unread in rows:
+        # 每个方向的消息同时属于发送者和接收者的会话
+        for user_id, partner_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+            summary = summaries.setdefault((user_id, partner_id), {
+                'user_id': user_id, 'partner_id': partner_id,
+                'last_message_id': last_id, 'last_date': last_date, 'unread_count': 0
+            })
+            if last_id > summary['last_message_id']:
+                summary['last_message_id'] = last_id
+                summary['last_date'] = last_date
+        summaries[(receiver_id, sender_id)]['unread_count'] += unread or 0
+
+    Conversation.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(Conversation, list(summaries.values()))
+    db.session.commit()
+    return len(summaries)
@@ -0,0 +1,165 @@
+from sqlalchemy import func, select
+
+from .models import db, Item, Follow, User, UserFollow, Notification, Message, Order
+
+# 商品热度权重：热度 = 浏览量 * 0.5 + 关注数 * 2 + 销量 * 5
+HOTNESS_VIEW_WEIGHT = 0.5
+HOTNESS_FOLLOW_WEIGHT = 2
+HOTNESS_SALES_WEIGHT = 5
+
+
+def hotness_expression():
+    """
+    返回按当前列值计算商品热度的SQL表达式
+
+    Returns:
+        ColumnElement: 热度计算表达式
+    """
+    return (Item.views * HOTNESS_VIEW_WEIGHT +
+            Item.follow_count * HOTNESS_FOLLOW_WEIGHT +
+            Item.sales_count * HOTNESS_SALES_WEIGHT)
+
+
+def bump_item_counters(item_id, views=0, follows=0, sales=0):
+    """
+    以单条UPDATE语句增量更新商品计数器，并同步维护热度列
+
+    不提交事务，由调用方与其他写操作在同一事务中一并提交。
+
+    Args:
+        item_id: 商品ID
+        views: 浏览量增量
+        follows: 关注数增量
+        sales: 销量增量
+    """
+    values = {}
+    if views:
+        values[Item.views] = Item.views + views
+    if follows:
+        values[Item.follow_count] = Item.follow_count + follows
+    if sales:
+        values[Item.sales_count] = Item.sales_count + sales
+    if not values:
+        return
+    delta = views * HOTNESS_VIEW_WEIGHT + follows * HOTNESS_FOLLOW_WEIGHT + sales * HOTNESS_SALES_WEIGHT
+    values[Item.hotness] = Item.hotness + delta
+    Item.query.filter(Item.id == item_id).update(values, synchronize_session='fetch')
+
+
+def bump_user_counters(user_id, followers=0, sales=0, items=0, following=0):
+    """
+    以单条UPDATE语句增量更新用户计数器
+
+    不提交事务，由调用方与其他写操作在同一事务中一并提交。
+
+    Args:
+        user_id: 用户ID
+        followers: 粉丝数增量
+        sales: 成交量增量
+        items: 发布的商品数增量
+        following: 关注的用户数增量
+    """
+    values = {}
+    if followers:
+        values[User.follower_count] = User.follower_count + followers
+    if sales:
+        values[User.sales_count] = User.sales_count + sales
+    if items:
+        values[User.item_count] = User.item_count + items
+    if following:
+        values[User.following_count] = User.following_count + following
+    if not values:
+        return
+    User.query.filter(User.id == user_id).update(values, synchronize_session='fetch')
+
+
+def bump_unread_counts(user_id, notifications=0, messages=0):
+    """
+    以单条UPDATE语句增量更新用户的未读通知数和未读私信数
+
+    不提交事务，由调用方与其他写操作在同一事务中一并提交。
+
+    Args:
+        user_id: 用户ID
+        notifications: 未读通知数增量
+        messages: 未读私信数增量
+    """
+    values = {}
+    if notifications:
+        values[User.unread_notification_count] = User.unread_notification_count + notifications
+    if messages:
+        values[User.unread_message_count] = User.unread_message_count + messages
+    if values:
+        User.query.filter(User.id == user_id).update(values, synchronize_session='fetch')
+
+
+def reconcile_item_counters():
+    """
+    根据Follow和Order表批量重新计算所有商品的关注数、已售数量和热度
+
+    用于新增列后的数据回填，以及修复计数器与实际数据的偏差。
+
+    Returns:
+        int: 被更新的商品数量
+    """
+    follow_count = (select(func.count(Follow.id))
+                    .where(Follow.item_id == Item.id)
+                    .correlate(Item)
+                    .scalar_subquery())
+    sales_count = (select(func.coalesce(func.sum(Order.quantity), 0))
+                   .where(Order.item_id == Item.id)
+                   .correlate(Item)
+                   .scalar_subquery())
+    result = db.session.execute(
+        Item.__table__.update().values(follow_count=follow_count, sales_count=sales_count)
+    )
+    db.session.execute(
+        Item.__table__.update().values(hotness=hotness_expression())
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def reconcile_user_counters():
+    """
+    根据UserFollow、Item、Order、Notification和Message表批量重新计算所有用户的粉丝数、关注数、商品数、成交量和未读数
+
+    Returns:
+        int: 被更新的用户数量
+    """
+    follower_count = (select(func.count(UserFollow.id))
+                      .where(UserFollow.followed_id == User.id)
+                      .correlate(User)
+                      .scalar_subquery())
+    unread_notifications = (select(func.count(Notification.id))
+                            .where(Notification.user_id == User.id, Notification.is_read == False)  # noqa: E712
+                            .correlate(User)
+                            .scalar_subquery())
+    following_count = (select(func.count(UserFollow.id))
+                       .where(UserFollow.follower_id == User.id)
+                       .correlate(User)
+                       .scalar_subquery())
+    item_count = (select(func.count(Item.id))
+                  .where(Item.user_id == User.id)
+                  .correlate(User)
+                  .scalar_subquery())
+    sales_count = (select(func.count(Order.id))
+                   .where(Order.seller_id == User.id)
+                   .correlate(User)
+                   .scalar_subquery())
+    unread_messages = (select(func.count(Message.id))
+                       .where(Message.receiver_id == User.id, Message.is_read == False)  # noqa: E712
+                       .correlate(User)
+                       .scalar_subquery())
+    result = db.session.execute(
+        User.__table__.update().values(
+            follower_count=follower_count,
+            following_count=following_count,
+            item_count=item_count,
+            sales_count=sales_count,
+            unread_notification_count=unread_notifications,
+            unread_message_count=unread_messages
+        )
+    )
+    db.session.commit()
+    return result.rowcount
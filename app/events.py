@@ -0,0 +1,143 @@
+import json
+import queue
+import threading
+import time
+
+from sqlalchemy import event
+
+from .models import db
+
+# 已提交事务中待推送的事件保存在session.info中的键
+PENDING_KEY = 'pending_events'
+
+
+class EventHub:
+    """
+    进程内的用户事件发布/订阅中心
+
+    私信和通知写入后向接收者推送事件，浏览器通过/events/stream（Server-Sent Events）
+    订阅，收到事件后更新未读角标和聊天窗口，不必反复刷新页面。
+    事件在业务事务提交后才推送，回滚的事务不会产生事件。
+    只能推送本进程内产生的事件，多进程部署时其他进程写入的私信和通知仍需刷新页面才能看到。
+    """
+
+    def __init__(self, app=None):
+        self.queue_size = 100
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._next_id = 0
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        绑定应用，注册事务提交和回滚的监听
+
+        Args:
+            app: Flask应用实例
+        """
+        self.queue_size = app.config.get('EVENT_QUEUE_SIZE', 100)
+        app.extensions['event_hub'] = self
+        if not self._listening:
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+            self._listening = True
+
+    def subscribe(self, user_id):
+        """
+        订阅用户的事件
+
+        Args:
+            user_id: 用户ID
+
+        Returns:
+            Queue: 接收事件的队列，不再使用时需调用unsubscribe
+        """
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id, subscriber):
+        """取消订阅"""
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_id, event_type, data):
+        """
+        立即向用户的所有订阅者推送事件
+
+        Args:
+            user_id: 接收事件的用户ID
+            event_type: 事件类型，如message、notification
+            data: 事件数据，需可序列化为JSON
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+            self._next_id += 1
+            item = (self._next_id, event_type, data)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(item)
+            except queue.Full:
+                # 客户端读取过慢时丢弃事件，页面刷新后仍能看到完整数据
+                pass
+
+    def publish_after_commit(self, user_id, event_type, data):
+        """
+        在当前事务提交后推送事件
+
+        Args:
+            user_id: 接收事件的用户ID
+            event_type: 事件类型
+            data: 事件数据
+        """
+        db.session.info.setdefault(PENDING_KEY, []).append((user_id, event_type, data))
+
+    def _after_commit(self, session):
+        for user_id, event_type, data in session.info.pop(PENDING_KEY, ()):
+            self.publish(user_id, event_type, data)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop(PENDING_KEY, None)
+
+    def stream(self, user_id, heartbeat=15, max_duration=300):
+        """
+        生成用户事件的Server-Sent Events响应内容
+
+        定期发送注释行作为心跳，防止代理关闭空闲连接；连接保持max_duration秒后
+        主动结束，由浏览器自动重连，避免长期占用工作线程。
+
+        Args:
+            user_id: 用户ID
+            heartbeat: 心跳间隔（秒）
+            max_duration: 单个连接的最长时间（秒）
+
+        Yields:
+            str: SSE格式的文本
+        """
+        subscriber = self.subscribe(user_id)
+        deadline = time.monotonic() + max_duration
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event_id, event_type, data = subscriber.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield f'id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+        finally:
+            self.unsubscribe(user_id, subscriber)
+
+
+# 全局事件中心，由app/__init__.py统一初始化
+event_hub = EventHub()
@@ -0,0 +1,147 @@
+from datetime import datetime
+
+from flask import g, has_request_context
+from sqlalchemy import and_, exists, insert, literal, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, UserFollow
+from .counters import bump_user_counters
+
+# 单条查询中IN列表的最大长度，SQL Server单条语句最多2100个参数
+LOOKUP_CHUNK_SIZE = 1000
+
+
+def _request_cache(viewer_id):
+    """
+    当前请求内已查询过的关注关系，{用户ID: (是否关注了对方, 对方是否关注了自己)}
+
+    只在请求上下文中缓存，命令行等场景每次都查询数据库。
+    """
+    if not has_request_context():
+        return {}
+    caches = g.setdefault('follow_graph', {})
+    return caches.setdefault(viewer_id, {})
+
+
+def follow_relations(viewer_id, user_ids):
+    """
+    批量查询用户与一组用户之间的双向关注关系
+
+    同一请求内查询过的关系会被缓存，页面中多处检查同一用户时不再重复查询。
+
+    Args:
+        viewer_id: 当前用户ID
+        user_ids: 需要检查的用户ID列表
+
+    Returns:
+        dict: {用户ID: (viewer是否关注了该用户, 该用户是否关注了viewer)}
+    """
+    cache = _request_cache(viewer_id)
+    missing = list({user_id for user_id in user_ids if user_id not in cache and user_id != viewer_id})
+    for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+        chunk = missing[start:start + LOOKUP_CHUNK_SIZE]
+        rows = db.session.query(UserFollow.follower_id, UserFollow.followed_id).filter(or_(
+            and_(UserFollow.follower_id == viewer_id, UserFollow.followed_id.in_(chunk)),
+            and_(UserFollow.followed_id == viewer_id, UserFollow.follower_id.in_(chunk)),
+        )).all()
+        following = {followed_id for follower_id, followed_id in rows if follower_id == viewer_id}
+        followed_by = {follower_id for follower_id, followed_id in rows if followed_id == viewer_id}
+        for user_id in chunk:
+            cache[user_id] = (user_id in following, user_id in followed_by)
+    return {user_id: cache.get(user_id, (False, False)) for user_id in user_ids}
+
+
+def following_ids(viewer_id, user_ids):
+    """
+    返回一组用户中被viewer关注的用户ID
+
+    Args:
+        viewer_id: 当前用户ID
+        user_ids: 需要检查的用户ID列表
+
+    Returns:
+        set: 被关注的用户ID集合
+    """
+    return {user_id for user_id, (following, _) in follow_relations(viewer_id, user_ids).items() if following}
+
+
+def follow_state(viewer_id, user_id):
+    """
+    查询两个用户之间的双向关注状态
+
+    Args:
+        viewer_id: 当前用户ID
+        user_id: 对方用户ID
+
+    Returns:
+        tuple: (viewer是否关注了对方, 对方是否关注了viewer)
+    """
+    return follow_relations(viewer_id, [user_id])[user_id]
+
+
+def add_follow(follower_id, followed_id):
+    """
+    关注用户，已关注时不做任何修改
+
+    以单条INSERT ... SELECT ... WHERE NOT EXISTS写入，并发的重复关注由
+    (follower_id, followed_id)唯一索引拒绝，因此重复提交不会产生重复记录，
+    粉丝数和关注数也只增加一次。
+    不提交事务，由调用方提交。
+
+    Args:
+        follower_id: 关注者ID
+        followed_id: 被关注者ID
+
+    Returns:
+        bool: 是否新建了关注关系
+    """
+    not_followed = ~exists().where(UserFollow.follower_id == follower_id,
+                                   UserFollow.followed_id == followed_id)
+    statement = insert(UserFollow).from_select(
+        ['follower_id', 'followed_id', 'date_followed'],
+        select(literal(follower_id), literal(followed_id), literal(datetime.utcnow())).where(not_followed)
+    )
+    try:
+        with db.session.begin_nested():
+            created = db.session.execute(statement).rowcount == 1
+    except IntegrityError:
+        # 并发请求已写入同一关注关系
+        created = False
+    if created:
+        bump_user_counters(followed_id, followers=1)
+        bump_user_counters(follower_id, following=1)
+    _update_cache(follower_id, followed_id, True)
+    return created
+
+
+def remove_follow(follower_id, followed_id):
+    """
+    取消关注用户，未关注时不做任何修改
+
+    不提交事务，由调用方提交。
+
+    Args:
+        follower_id: 关注者ID
+        followed_id: 被关注者ID
+
+    Returns:
+        bool: 是否删除了关注关系
+    """
+    deleted = UserFollow.query.filter_by(
+        follower_id=follower_id, followed_id=followed_id
+    ).delete(synchronize_session=False)
+    if deleted:
+        bump_user_counters(followed_id, followers=-1)
+        bump_user_counters(follower_id, following=-1)
+    _update_cache(follower_id, followed_id, False)
+    return bool(deleted)
+
+
+def _update_cache(follower_id, followed_id, following):
+    """写入关注关系后同步更新当前请求内双方的缓存"""
+    follower_cache = _request_cache(follower_id)
+    if followed_id in follower_cache:
+        follower_cache[followed_id] = (following, follower_cache[followed_id][1])
+    followed_cache = _request_cache(followed_id)
+    if follower_id in followed_cache:
+        followed_cache[follower_id] = (followed_cache[follower_id][0], following)
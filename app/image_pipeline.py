@@ -0,0 +1,326 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# 各尺寸版本的文件名后缀和最大尺寸（保持宽高比），无后缀的主图即详情页使用的版本
+PICTURE_VARIANTS = {
+    'full': ('_full', (1600, 1600)),
+    'detail': ('', (800, 800)),
+    'thumb': ('_thumb', (400, 400)),
+}
+AVATAR_VARIANTS = {
+    'detail': ('', (125, 125)),
+    'thumb': ('_thumb', (64, 64)),
+}
+# 每个尺寸在原格式之外另存一份WebP
+WEBP_QUALITY = 80
+ORIGINAL_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# 文件名取内容哈希的前16位十六进制字符
+HASH_LENGTH = 16
+
+
+def variants_for(relative_path):
+    """返回图片适用的尺寸版本配置"""
+    return AVATAR_VARIANTS if relative_path.startswith('avatars') else PICTURE_VARIANTS
+
+
+def variant_path(relative_path, size=None, webp=False):
+    """
+    返回图片某个尺寸版本的相对路径
+
+    Args:
+        relative_path: 主图相对上传目录的路径
+        size: 尺寸版本名，如thumb、full，默认为主图
+        webp: 是否返回WebP版本
+
+    Returns:
+        str: 该版本相对上传目录的路径
+    """
+    stem, ext = os.path.splitext(relative_path)
+    suffix = variants_for(relative_path).get(size or 'detail', ('', None))[0]
+    return stem + suffix + ('.webp' if webp else ext)
+
+
+class ImagePipeline:
+    """
+    上传图片异步处理管道
+
+    上传请求只把原图写入暂存目录(uploads/staging)后立即返回，由固定大小的
+    后台线程池生成各尺寸的原格式和WebP版本并移动到上传目录，主图最后写入，
+    处理完成前页面显示默认图片。
+    排队的图片超过IMAGE_QUEUE_SIZE张时在请求中同步处理，以此限制内存和磁盘
+    占用；处理失败时重试IMAGE_MAX_RETRIES次。
+    """
+
+    def __init__(self, app=None):
+        self.upload_folder = None
+        self.max_retries = 2
+        self._executor = None
+        self._slots = None
+        self._ready_callbacks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        绑定应用并创建后台线程池
+
+        Args:
+            app: Flask应用实例
+        """
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        self.max_retries = app.config.get('IMAGE_MAX_RETRIES', 2)
+        app.extensions['image_pipeline'] = self
+        workers = app.config.get('IMAGE_WORKERS', 2)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-pipeline')
+            self._slots = threading.BoundedSemaphore(app.config.get('IMAGE_QUEUE_SIZE', 32))
+
+    def _staging_path(self, relative_path):
+        return os.path.join(self.upload_folder, 'staging', relative_path)
+
+    def _final_path(self, relative_path):
+        return os.path.join(self.upload_folder, relative_path)
+
+    def store(self, file_storage, folder='', retain=None):
+        """
+        按内容哈希保存上传的原图并排队处理
+
+        文件名由原图内容的SHA-256生成，相同内容的图片已存在或正在处理时
+        直接复用，不再写入和处理。复用前先调用retain登记引用：垃圾回收在删除
+        引用记录的同一事务中删除文件，登记完成后仍不存在的图片会重新暂存处理，
+        不会复用一个正在被回收的文件名。
+
+        Args:
+            file_storage: 上传的文件对象
+            folder: 上传目录下的子目录，头像为avatars
+            retain: 登记引用的回调，参数为图片相对上传目录的路径
+
+        Returns:
+            str: 处理后图片相对上传目录的路径，如avatars/abc.png
+
+        Raises:
+            Exception: 上传的文件不是可识别的图片
+        """
+        ext = os.path.splitext(file_storage.filename)[1].lower()
+        # 文件名列长度为20，统一使用.jpg扩展名
+        if ext == '.jpeg':
+            ext = '.jpg'
+        staging_folder = self._staging_path(folder)
+        os.makedirs(staging_folder, exist_ok=True)
+        # 边写入暂存文件边计算哈希，只读取一遍上传内容
+        fd, temp_path = tempfile.mkstemp(dir=staging_folder, prefix='.upload-')
+        digest = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: file_storage.stream.read(64 * 1024), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        filename = digest.hexdigest()[:HASH_LENGTH] + ext
+        relative_path = f'{folder}/{filename}' if folder else filename
+        try:
+            # 只读取文件头，确认是图片后再登记引用和排队，避免无效文件进入后台处理
+            with Image.open(temp_path):
+                pass
+        except Exception:
+            os.remove(temp_path)
+            raise
+        if retain is not None:
+            retain(relative_path)
+        if self.status(relative_path) != 'failed':
+            os.remove(temp_path)
+            return relative_path
+        os.replace(temp_path, self._staging_path(relative_path))
+        self.enqueue(relative_path)
+        return relative_path
+
+    def enqueue(self, relative_path):
+        """
+        将暂存目录中的图片交给线程池处理，队列已满或未启用线程池时同步处理
+
+        Args:
+            relative_path: 图片相对上传目录的路径
+        """
+        if self._executor is not None and self._slots.acquire(blocking=False):
+            future = self._executor.submit(self._process_with_retry, relative_path)
+            future.add_done_callback(lambda _: self._slots.release())
+        else:
+            self._process_with_retry(relative_path)
+
+    def on_ready(self, callback):
+        """
+        注册图片处理完成后的回调，用于让缓存了默认图片的页面失效
+
+        回调在处理图片的线程中执行，参数为图片相对上传目录的路径。
+
+        Args:
+            callback: 回调函数
+        """
+        self._ready_callbacks.append(callback)
+        return callback
+
+    def _process_with_retry(self, relative_path):
+        # 相同内容的图片可能被重复排队，已处理完成的直接跳过
+        if not os.path.exists(self._staging_path(relative_path)):
+            return self.is_ready(relative_path)
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._process(relative_path)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    print(f"图片处理失败: {relative_path}: {e}")
+                    staging_path = self._staging_path(relative_path)
+                    if os.path.exists(staging_path):
+                        os.remove(staging_path)
+                    return False
+                time.sleep(0.5 * 2 ** attempt)
+            else:
+                self._notify_ready(relative_path)
+                return True
+
+    def _notify_ready(self, relative_path):
+        for callback in self._ready_callbacks:
+            try:
+                callback(relative_path)
+            except Exception as e:
+                print(f"图片处理完成回调失败: {relative_path}: {e}")
+
+    def _process(self, relative_path):
+        staging_path = self._staging_path(relative_path)
+        with Image.open(staging_path) as image:
+            image.load()
+            self._write_variants(image, relative_path)
+        os.remove(staging_path)
+
+    def _write_variants(self, image, relative_path, rewrite_main=True):
+        variants = variants_for(relative_path)
+        # 主图最后写入，主图存在即表示所有版本都已生成
+        for size in sorted(variants, key=lambda name: variants[name][0] == ''):
+            resized = image.copy()
+            resized.thumbnail(variants[size][1])
+            self._save(resized, variant_path(relative_path, size, webp=True))
+            if rewrite_main or variants[size][0]:
+                self._save(resized, variant_path(relative_path, size))
+
+    def _save(self, image, relative_path):
+        final_path = self._final_path(relative_path)
+        folder, filename = os.path.split(final_path)
+        os.makedirs(folder, exist_ok=True)
+        # 先写入临时文件再原子替换，页面不会读到写了一半的图片
+        temp_path = os.path.join(folder, '.processing-' + filename)
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == '.webp':
+            image.save(temp_path, quality=WEBP_QUALITY)
+        elif ext in ['.jpg', '.jpeg']:
+            # 对于JPEG格式设置质量参数，带透明通道的图片先转为RGB
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(temp_path, quality=85, optimize=True)
+        else:
+            image.save(temp_path)
+        os.replace(temp_path, final_path)
+
+    def status(self, relative_path):
+        """
+        查询图片的处理状态
+
+        Args:
+            relative_path: 图片相对上传目录的路径
+
+        Returns:
+            str: ready（已可访问）、pending（排队或处理中）或failed（处理失败）
+        """
+        if os.path.exists(self._final_path(relative_path)):
+            return 'ready'
+        if os.path.exists(self._staging_path(relative_path)):
+            return 'pending'
+        return 'failed'
+
+    def is_ready(self, relative_path):
+        """图片是否已处理完成"""
+        return os.path.exists(self._final_path(relative_path))
+
+    def delete(self, relative_path):
+        """
+        删除图片的所有尺寸版本，以及仍在暂存目录中的原图
+
+        Args:
+            relative_path: 主图相对上传目录的路径
+        """
+        paths = [self._staging_path(relative_path)]
+        for size in variants_for(relative_path):
+            paths.append(self._final_path(variant_path(relative_path, size)))
+            paths.append(self._final_path(variant_path(relative_path, size, webp=True)))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def process_staged(self):
+        """
+        同步处理暂存目录中遗留的图片，用于进程意外退出后的恢复
+
+        Returns:
+            int: 处理成功的图片数量
+        """
+        staging_folder = self._staging_path('')
+        count = 0
+        for root, _, files in os.walk(staging_folder):
+            for filename in files:
+                # 跳过仍在写入的上传文件
+                if filename.startswith('.'):
+                    continue
+                relative_path = os.path.relpath(os.path.join(root, filename), staging_folder).replace(os.sep, '/')
+                if self._process_with_retry(relative_path):
+                    count += 1
+        return count
+
+    def main_images(self):
+        """列出上传目录和头像目录中的主图"""
+        suffixes = {suffix for variants in (PICTURE_VARIANTS, AVATAR_VARIANTS)
+                    for suffix, _ in variants.values() if suffix}
+        for folder in ('', 'avatars'):
+            path = os.path.join(self.upload_folder, folder)
+            if not os.path.isdir(path):
+                continue
+            for filename in sorted(os.listdir(path)):
+                stem, ext = os.path.splitext(filename)
+                if (filename.startswith('.') or ext.lower() not in ORIGINAL_EXTENSIONS
+                        or any(stem.endswith(suffix) for suffix in suffixes)):
+                    continue
+                yield f'{folder}/{filename}' if folder else filename
+
+    def backfill_variants(self):
+        """
+        为已有的主图补齐缺失的尺寸版本和WebP版本
+
+        已处理过的主图不再重新编码；补齐的版本由主图缩放得到，
+        因此不会大于主图。
+
+        Returns:
+            int: 补齐了版本的图片数量
+        """
+        count = 0
+        for relative_path in self.main_images():
+            expected = [variant_path(relative_path, size, webp)
+                        for size in variants_for(relative_path) for webp in (False, True)]
+            if all(self.is_ready(path) for path in expected):
+                continue
+            try:
+                with Image.open(self._final_path(relative_path)) as image:
+                    image.load()
+                    self._write_variants(image, relative_path, rewrite_main=False)
+                count += 1
+            except Exception as e:
+                print(f"图片处理失败: {relative_path}: {e}")
+        return count
+
+
+# 全局图片处理管道，由app/__init__.py统一初始化
+image_pipeline = ImagePipeline()
@@ -0,0 +1,110 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from .models import db, Item, User, LeaderboardEntry
+
+# 商品榜热度 = 浏览量 * 1 + 关注量 * 3 + 已售数量 * 5
+ITEM_SCORE = Item.views + Item.follow_count * 3 + Item.sales_count * 5
+# 用户榜热度 = 人气 * 3 + 成交量 * 2 + 主页浏览量 * 1
+USER_SCORE = User.follower_count * 3 + User.sales_count * 2 + User.views
+
+BOARDS = {
+    'item': (Item, ITEM_SCORE),
+    'user': (User, USER_SCORE),
+}
+
+
+def refresh_leaderboards(limit=10):
+    """
+    重新计算所有排行榜的前limit名并写入快照表
+
+    每个榜单只取前limit名，不再把整张表加载到内存中排序。
+
+    Args:
+        limit: 每个榜单保留的条数
+    """
+    now = datetime.utcnow()
+    try:
+        for board, (model, score) in BOARDS.items():
+            rows = (db.session.query(model.id, score)
+                    .order_by(score.desc(), model.id.asc())
+                    .limit(limit)
+                    .all())
+            LeaderboardEntry.query.filter_by(board=board).delete(synchronize_session=False)
+            db.session.bulk_insert_mappings(LeaderboardEntry, [
+                {'board': board, 'rank': rank, 'entity_id': entity_id, 'score': entity_score, 'refreshed_at': now}
+                for rank, (entity_id, entity_score) in enumerate(rows, start=1)
+            ])
+        db.session.commit()
+    except Exception as e:
+        # 多个进程同时刷新时可能发生唯一约束冲突，保留已有快照即可
+        db.session.rollback()
+        current_app.logger.warning('刷新排行榜失败: %s', e)
+
+
+# 后台刷新状态：同一进程内同时只有一个刷新线程，且每max_age秒最多刷新一次
+_refresh_lock = threading.Lock()
+_refreshing = False
+_last_refresh = None
+
+
+def _schedule_refresh(limit, max_age):
+    """快照过期时在后台线程中刷新，请求不等待刷新完成"""
+    global _refreshing, _last_refresh
+    now = time.monotonic()
+    with _refresh_lock:
+        if _refreshing or (_last_refresh is not None and now - _last_refresh < max_age):
+            return
+        _refreshing = True
+        _last_refresh = now
+    app = current_app._get_current_object()
+
+    def run():
+        global _refreshing
+        try:
+            with app.app_context():
+                refresh_leaderboards(limit)
+        finally:
+            with _refresh_lock:
+                _refreshing = False
+
+    threading.Thread(target=run, name='leaderboard-refresh', daemon=True).start()
+
+
+def _read_board(board, limit):
+    """按名次读取榜单快照，并一次性加载榜单上的对象"""
+    model, _ = BOARDS[board]
+    query = (db.session.query(LeaderboardEntry, model)
+             .join(model, model.id == LeaderboardEntry.entity_id)
+             .filter(LeaderboardEntry.board == board))
+    if model is Item:
+        # 商品榜需要展示卖家信息，一并加载避免逐条查询
+        query = query.options(joinedload(Item.seller))
+    return query.order_by(LeaderboardEntry.rank.asc()).limit(limit).all()
+
+
+def get_leaderboard(board, limit=10, max_age=300):
+    """
+    读取排行榜快照
+
+    总是直接返回已有的快照；快照超过max_age秒（或尚未生成）时在后台刷新一次，
+    请求本身只执行一次按名次的索引读取。也可以由refresh-leaderboards定时刷新。
+
+    Args:
+        board: 榜单名称，item或user
+        limit: 返回条数
+        max_age: 快照最长有效时间（秒），即排行榜数据的最大延迟
+
+    Returns:
+        tuple: (按名次排列的(对象, 热度值)列表, 快照刷新时间, 快照是否已过期)
+    """
+    entries = _read_board(board, limit)
+    refreshed_at = entries[0][0].refreshed_at if entries else None
+    stale = refreshed_at is None or datetime.utcnow() - refreshed_at > timedelta(seconds=max_age)
+    if stale:
+        _schedule_refresh(limit, max_age)
+    return [(obj, entry.score) for entry, obj in entries], refreshed_at, stale
@@ -0,0 +1,169 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
+from .models import db, Item, Request, MatchToken
+from .search import tokenize, TITLE_WEIGHT
+from .notifications import notification_queue, notification_event
+
+# 参与匹配的文档类型：(模型, 匹配对象的类型, 通知类型)
+# 新商品通知匹配求购的发布者，新求购通知匹配商品的卖家
+MATCH_SOURCES = {
+    'item': (Item, 'request', 'match_request'),
+    'request': (Request, 'item', 'match_item'),
+}
+
+
+def _kind_of(obj):
+    for kind, (model, _, _) in MATCH_SOURCES.items():
+        if isinstance(obj, model):
+            return kind
+    raise ValueError(f'不支持匹配的对象: {obj!r}')
+
+
+def index_listing(obj):
+    """
+    更新商品或求购在匹配索引中的词和价格，发布和编辑后调用
+
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        obj: Item或Request对象
+    """
+    kind = _kind_of(obj)
+    if obj.id is None:
+        db.session.flush()
+    remove_listing(obj)
+    _insert_tokens(kind, obj.id, obj.title, obj.description, obj.price)
+
+
+def _insert_tokens(kind, doc_id, title, description, price):
+    weights = Counter()
+    for token in tokenize(title):
+        weights[token] += TITLE_WEIGHT
+    for token in tokenize(description):
+        weights[token] += 1
+    db.session.bulk_insert_mappings(MatchToken, [
+        {'kind': kind, 'token': token, 'doc_id': doc_id, 'price': price, 'weight': weight}
+        for token, weight in weights.items()
+    ])
+
+
+def remove_listing(obj):
+    """
+    从匹配索引中删除商品或求购
+
+    不提交事务，由调用方提交。
+
+    Args:
+        obj: Item或Request对象
+    """
+    MatchToken.query.filter_by(kind=_kind_of(obj), doc_id=obj.id).delete(synchronize_session=False)
+
+
+def find_matches(obj, limit):
+    """
+    查找与商品匹配的求购，或与求购匹配的商品
+
+    以新文档标题中的词在索引中查找对方类型的候选文档，价格条件也在索引中过滤：
+    商品售价不超过求购期望价格的(1 + MATCH_PRICE_TOLERANCE)倍。
+    查询开销与命中这些词且价格合适的候选数相关，与商品和求购的总数无关。
+    只返回其他用户发布的、仍在售的商品和最近MATCH_REQUEST_MAX_AGE_DAYS天内的求购。
+
+    Args:
+        obj: Item或Request对象
+        limit: 最多返回的文档数
+
+    Returns:
+        list: 按匹配得分从高到低排列的Item或Request对象
+    """
+    kind = _kind_of(obj)
+    _, target_kind, _ = MATCH_SOURCES[kind]
+    target_model = MATCH_SOURCES[target_kind][0]
+    tokens = sorted(set(tokenize(obj.title)))
+    if not tokens:
+        return []
+    config = current_app.config
+    tolerance = 1 + config['MATCH_PRICE_TOLERANCE']
+    if kind == 'item':
+        price_condition = MatchToken.price * tolerance >= obj.price
+    else:
+        price_condition = MatchToken.price <= obj.price * tolerance
+    min_tokens = min(config['MATCH_MIN_TOKENS'], len(tokens))
+    matches = (db.session.query(MatchToken.doc_id.label('doc_id'),
+                                func.sum(MatchToken.weight).label('score'))
+               .filter(MatchToken.kind == target_kind, MatchToken.token.in_(tokens), price_condition)
+               .group_by(MatchToken.doc_id)
+               .having(func.count(func.distinct(MatchToken.token)) >= min_tokens)
+               .subquery())
+    query = (target_model.query
+             .join(matches, target_model.id == matches.c.doc_id)
+             .filter(target_model.user_id != obj.user_id))
+    if target_kind == 'item':
+        query = query.filter(Item.stock > 0)
+    else:
+        cutoff = datetime.utcnow() - timedelta(days=config['MATCH_REQUEST_MAX_AGE_DAYS'])
+        query = query.filter(Request.date_posted >= cutoff)
+    return query.order_by(matches.c.score.desc(), target_model.id.desc()).limit(limit).all()
+
+
+def match_listing(obj, sender):
+    """
+    为新发布的商品或求购建立匹配索引，并批量通知匹配到的对方用户
+
+    每个用户只通知一次，最多通知MATCH_MAX_NOTIFICATIONS个用户。
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        obj: 新发布的Item或Request对象
+        sender: 发布者
+
+    Returns:
+        int: 发送的通知数
+    """
+    index_listing(obj)
+    _, _, notification_type = MATCH_SOURCES[_kind_of(obj)]
+    limit = current_app.config['MATCH_MAX_NOTIFICATIONS']
+    recipients = []
+    # 同一用户的多条候选只通知一次，多取一些候选以便去重后仍有足够的用户
+    for match in find_matches(obj, limit * 2):
+        if match.user_id not in recipients:
+            recipients.append(match.user_id)
+    events = [notification_event(user_id, sender, notification_type, obj.id, obj.title)
+              for user_id in recipients[:limit]]
+    if events:
+        notification_queue.emit(*events)
+    return len(events)
+
+
+def rebuild_match_index(batch_size=1000):
+    """
+    清空并重建匹配索引
+
+    Args:
+        batch_size: 每批读取的文档数
+
+    Returns:
+        int: 建立索引的文档数量
+    """
+    MatchToken.query.delete(synchronize_session=False)
+    count = 0
+    for kind, (model, _, _) in MATCH_SOURCES.items():
+        last_id = 0
+        while True:
+            rows = (db.session.query(model.id, model.title, model.description, model.price)
+                    .filter(model.id > last_id)
+                    .order_by(model.id.asc())
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                break
+            for doc_id, title, description, price in rows:
+                _insert_tokens(kind, doc_id, title, description, price)
+            last_id = rows[-1][0]
+            count += len(rows)
+            db.session.commit()
+    db.session.commit()
+    return count
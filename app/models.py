@@ -16,6 +16,11 @@ class User(db.Model, UserMixin):
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
     sales_count = db.Column(db.Integer, nullable=False, default=0)  # 成交量统计
     views = db.Column(db.Integer, nullable=False, default=0, index=True)  # 主页访问量统计
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 粉丝数（冗余计数，随关注/取消关注同步维护）
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 关注的用户数（冗余计数）
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 发布的商品数（冗余计数，随发布/删除商品同步维护）
+    unread_notification_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 未读通知数（冗余计数）
+    unread_message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 未读私信数（冗余计数）
     items = db.relationship('Item', backref='seller', lazy=True)
 
 class Item(db.Model):
@@ -29,7 +34,13 @@ class Item(db.Model):
     views = db.Column(db.Integer, nullable=False, default=0, index=True)
     stock = db.Column(db.Integer, nullable=False, default=1)
     sales_count = db.Column(db.Integer, nullable=False, default=0, index=True)  # 已售数量统计
+    follow_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)  # 关注数（冗余计数，随关注/取消关注同步维护）
+    hotness = db.Column(db.Float, nullable=False, default=0, server_default='0', index=True)  # 热度 = 浏览量 * 0.5 + 关注数 * 2 + 销量 * 5
     followers = db.relationship('Follow', backref='item', lazy=True)
+    __table_args__ = (
+        # 个人主页按发布时间列出某用户的商品
+        db.Index('ix_item_user_date_posted', 'user_id', 'date_posted'),
+    )
 
 class Follow(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -37,6 +48,12 @@ class Follow(db.Model):
     item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False, index=True)
     date_followed = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     user = db.relationship('User', backref='follows', lazy=True)
+    __table_args__ = (
+        # 同一用户对同一商品只能关注一次，同时用于关注状态查询
+        db.Index('ix_follow_user_item', 'user_id', 'item_id', unique=True),
+        # 个人主页按关注时间列出关注的商品
+        db.Index('ix_follow_user_date_followed', 'user_id', 'date_followed'),
+    )
 
 class Request(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -47,6 +64,9 @@ class Request(db.Model):
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship('User', backref='requests', lazy=True)
+    __table_args__ = (
+        db.Index('ix_request_user_date_posted', 'user_id', 'date_posted'),
+    )
 
 # 交流广场模型
 class Post(db.Model):
@@ -60,6 +80,9 @@ class Post(db.Model):
     likes = db.relationship('Like', backref='post', lazy='dynamic', cascade='all, delete-orphan')
     # 明确指定使用post_id外键
     replies = db.relationship('Reply', backref='post', foreign_keys='Reply.post_id', lazy='dynamic', cascade='all, delete-orphan')
+    __table_args__ = (
+        db.Index('ix_post_user_date_posted', 'user_id', 'date_posted'),
+    )
 
 # 点赞模型
 class Like(db.Model):
@@ -68,6 +91,10 @@ class Like(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False, index=True)
     user = db.relationship('User', backref='likes', lazy=True)
+    __table_args__ = (
+        # 同一用户对同一帖子只能点赞一次
+        db.Index('ix_like_user_post', 'user_id', 'post_id', unique=True),
+    )
 
 # 回复点赞模型
 class ReplyLike(db.Model):
@@ -78,6 +105,10 @@ class ReplyLike(db.Model):
     user = db.relationship('User', backref='reply_likes', lazy=True)
     # 建立与Reply模型的关系，通过backref创建反向引用
     reply = db.relationship('Reply', backref=db.backref('likes', lazy='dynamic', cascade='all, delete-orphan'), lazy=True)
+    __table_args__ = (
+        # 同一用户对同一回复只能点赞一次
+        db.Index('ix_reply_like_user_reply', 'user_id', 'reply_id', unique=True),
+    )
 
 # 用户关注模型
 class UserFollow(db.Model):
@@ -89,6 +120,12 @@ class UserFollow(db.Model):
     # 关系定义
     follower = db.relationship('User', foreign_keys=[follower_id], backref=db.backref('following', lazy='dynamic', cascade='all, delete-orphan'))
     followed = db.relationship('User', foreign_keys=[followed_id], backref=db.backref('followers', lazy='dynamic', cascade='all, delete-orphan'))
+    __table_args__ = (
+        # 同一用户只能关注另一用户一次，同时用于关注状态查询
+        db.Index('ix_user_follow_follower_followed', 'follower_id', 'followed_id', unique=True),
+        # 个人主页按关注时间分页列出关注的用户
+        db.Index('ix_user_follow_follower_date_followed', 'follower_id', 'date_followed'),
+    )
 
 # 回复模型
 class Reply(db.Model):
@@ -104,6 +141,11 @@ class Reply(db.Model):
     quoted_reply_id = db.Column(db.Integer, db.ForeignKey('reply.id', ondelete='SET NULL'), nullable=True)
     quoted_reply = db.relationship('Reply', remote_side=[id], backref='quoted_in_replies', lazy=True)
     user = db.relationship('User', backref='replies', lazy=True)
+    __table_args__ = (
+        # 交流广场按帖子列出回复
+        db.Index('ix_reply_post_date_posted', 'post_id', 'date_posted'),
+        db.Index('ix_reply_user_date_posted', 'user_id', 'date_posted'),
+    )
 
 # 私信模型
 class Message(db.Model):
@@ -116,21 +158,49 @@ class Message(db.Model):
     # 关联发送者和接收者
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages', lazy=True)
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref='received_messages', lazy=True)
+    __table_args__ = (
+        # 聊天记录按(发送者, 接收者)两个方向分别定位后按时间排序
+        db.Index('ix_message_sender_receiver_date_sent', 'sender_id', 'receiver_id', 'date_sent'),
+        # 未读消息计数
+        db.Index('ix_message_receiver_sender_is_read', 'receiver_id', 'sender_id', 'is_read'),
+    )
+
+# 会话摘要模型，每对(用户, 对话方)一行，随私信发送和阅读同步维护，私信列表直接按此表分页读取
+class Conversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    partner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    last_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)  # 对话方发来的未读消息数
+    partner = db.relationship('User', foreign_keys=[partner_id], lazy=True)
+    last_message = db.relationship('Message', foreign_keys=[last_message_id], lazy=True)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'partner_id', name='_conversation_user_partner_uc'),
+        db.Index('ix_conversation_user_last_date', 'user_id', 'last_date'),
+    )
 
 # 通知模型
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
-    notification_type = db.Column(db.String(50), nullable=False, index=True)  # follow_user, follow_item, reply_post, reply_reply, like_post, like_reply
+    notification_type = db.Column(db.String(50), nullable=False, index=True)  # follow_user, follow_item, reply_post, reply_reply, like_post, like_reply, buy_item
     content = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Boolean, nullable=False, default=False, index=True)
     date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
-    related_id = db.Column(db.Integer, nullable=True)  # 关联的对象ID（商品ID、帖子ID、回复ID等）
+    related_id = db.Column(db.Integer, nullable=True)  # 关联的对象ID（商品ID、订单ID、帖子ID、回复ID等）
+    actor_count = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # 合并的点赞通知中的点赞人数
     
     # 关联用户
     user = db.relationship('User', foreign_keys=[user_id], backref='notifications', lazy=True)
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_notifications', lazy=True)
+    __table_args__ = (
+        # 未读通知计数
+        db.Index('ix_notification_user_is_read', 'user_id', 'is_read'),
+        # 通知列表按时间倒序分页
+        db.Index('ix_notification_user_date_created', 'user_id', 'date_created'),
+    )
 
 # 库存模型
 class Stock(db.Model):
@@ -142,6 +212,53 @@ class Stock(db.Model):
     date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship('User', backref='stocks', lazy=True)
+    __table_args__ = (
+        # 购买时按名称查找买家已有的库存
+        db.Index('ix_stock_user_name', 'user_id', 'name'),
+        db.Index('ix_stock_user_date_added', 'user_id', 'date_added'),
+    )
+
+# 订单模型，购买时写入，记录成交时的数量和单价
+class Order(db.Model):
+    __tablename__ = 'orders'  # order是SQL保留字
+    id = db.Column(db.Integer, primary_key=True)
+    buyer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=True, index=True)  # 商品删除后置空
+    item_title = db.Column(db.String(100), nullable=False)  # 成交时的商品标题
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)  # 成交时的单价
+    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    buyer = db.relationship('User', foreign_keys=[buyer_id], backref='purchases', lazy=True)
+    seller = db.relationship('User', foreign_keys=[seller_id], backref='sales', lazy=True)
+    item = db.relationship('Item', backref='orders', lazy=True)
+    __table_args__ = (
+        # 买家的购买记录和卖家的销售记录按时间倒序分页
+        db.Index('ix_orders_buyer_date_created', 'buyer_id', 'date_created'),
+        db.Index('ix_orders_seller_date_created', 'seller_id', 'date_created'),
+    )
+
+    @property
+    def total_price(self):
+        return self.unit_price * self.quantity
+
+# 关注动态时间线，关注的用户发布商品、求购或帖子时写入粉丝的时间线
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entry'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # 时间线所属用户
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # 内容发布者
+    kind = db.Column(db.String(10), nullable=False)  # item、request或post
+    ref_id = db.Column(db.Integer, nullable=False)  # 内容ID
+    date_created = db.Column(db.DateTime, nullable=False)  # 内容发布时间
+    __table_args__ = (
+        # 读取时间线：按用户和发布时间倒序的范围读取
+        db.Index('ix_timeline_entry_user_date_created', 'user_id', 'date_created'),
+        # 同一内容在同一时间线中只出现一次
+        db.Index('ix_timeline_entry_user_kind_ref', 'user_id', 'kind', 'ref_id', unique=True),
+        # 删除内容时从所有时间线中移除
+        db.Index('ix_timeline_entry_kind_ref', 'kind', 'ref_id'),
+    )
 
 # 商品评论模型
 class Comment(db.Model):
@@ -153,6 +270,10 @@ class Comment(db.Model):
     item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False, index=True)
     user = db.relationship('User', backref='comments', lazy=True)
     item = db.relationship('Item', backref='comments', lazy=True)
+    __table_args__ = (
+        # 商品详情页按时间倒序列出评论
+        db.Index('ix_comment_item_date_posted', 'item_id', 'date_posted'),
+    )
     # 关联回复和点赞
     replies = db.relationship('CommentReply', backref='comment', lazy='dynamic', cascade='all, delete-orphan')
     likes = db.relationship('CommentLike', backref='comment', lazy='dynamic', cascade='all, delete-orphan')
@@ -175,3 +296,67 @@ class CommentLike(db.Model):
     user = db.relationship('User', backref='comment_likes', lazy=True)
     # 确保一个用户只能点赞一次
     __table_args__ = (db.UniqueConstraint('user_id', 'comment_id', name='_user_comment_like_uc'),)
+
+# 排行榜快照模型，由定期重算任务写入，排行榜页面按(board, rank)直接读取
+class LeaderboardEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    board = db.Column(db.String(20), nullable=False)  # item, user
+    rank = db.Column(db.Integer, nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)  # 商品ID或用户ID
+    score = db.Column(db.Float, nullable=False, default=0)
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('board', 'rank', name='_leaderboard_board_rank_uc'),)
+
+# 商品相似度快照，由refresh-recommendations根据关注和购买记录离线计算，每个商品保留前K个相似商品
+class ItemSimilarity(db.Model):
+    __tablename__ = 'item_similarity'
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, nullable=False)
+    similar_item_id = db.Column(db.Integer, nullable=False)  # 商品删除后读取时通过联结排除
+    rank = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    __table_args__ = (
+        # 商品详情页按名次读取相似商品
+        db.Index('ix_item_similarity_item_rank', 'item_id', 'rank', unique=True),
+    )
+
+# 搜索倒排索引模型，每行记录某个文档中出现的一个词及其权重
+class SearchToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # item, request, post
+    token = db.Column(db.String(40), nullable=False)
+    doc_id = db.Column(db.Integer, nullable=False)
+    weight = db.Column(db.Float, nullable=False, default=1)  # 标题中的词权重更高
+    __table_args__ = (
+        # 按词查找文档
+        db.Index('ix_search_token_kind_token_doc', 'kind', 'token', 'doc_id'),
+        # 文档更新或删除时清理旧词
+        db.Index('ix_search_token_kind_doc', 'kind', 'doc_id'),
+    )
+
+# 求购与商品匹配用的倒排索引，每行记录某个商品或求购中的一个词，并冗余保存价格用于价格区间过滤
+class MatchToken(db.Model):
+    __tablename__ = 'match_token'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # item, request
+    token = db.Column(db.String(40), nullable=False)
+    doc_id = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)  # 商品售价或求购期望价格
+    weight = db.Column(db.Float, nullable=False, default=1)  # 标题中的词权重更高
+    __table_args__ = (
+        # 按词和价格区间查找候选文档
+        db.Index('ix_match_token_kind_token_price', 'kind', 'token', 'price'),
+        # 文档更新或删除时清理旧词
+        db.Index('ix_match_token_kind_doc', 'kind', 'doc_id'),
+    )
+
+# 上传图片引用计数模型，图片按内容哈希命名，相同内容只保存一份
+class UploadBlob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(40), nullable=False, unique=True)  # 相对上传目录的路径，如avatars/abc.png
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    date_released = db.Column(db.DateTime, nullable=True)  # 引用数最近一次减少的时间
+    __table_args__ = (
+        # 垃圾回收按引用数和释放时间查找待删除的图片
+        db.Index('ix_upload_blob_ref_count_date_released', 'ref_count', 'date_released'),
+    )
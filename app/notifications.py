@@ -0,0 +1,306 @@
+import time
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, event
+
+from .models import db, User, Notification, Like, ReplyLike
+from .counters import bump_unread_counts
+from .events import event_hub
+
+# 各类通知的内容模板
+NOTIFICATION_TEMPLATES = {
+    'follow_item': '{sender} 关注了您的商品 "{title}"',
+    'follow_user': '{sender} 关注了您',
+    'like_post': '{sender} 点赞了您的帖子',
+    'like_reply': '{sender} 点赞了您的回复',
+    'reply_post': '{sender} 回复了您的帖子',
+    'reply_reply': '{sender} 回复了您的评论',
+    'buy_item': '{sender} 购买了你的商品 "{title}"！',
+    'match_request': '{sender} 发布的商品 "{title}" 符合您的求购',
+    'match_item': '{sender} 发布的求购 "{title}" 与您的商品相符',
+}
+# 可合并的通知类型：合并窗口内同一对象的未读通知合并为一条
+COALESCED_TEMPLATES = {
+    'like_post': '{sender} 等{count}人点赞了您的帖子',
+    'like_reply': '{sender} 等{count}人点赞了您的回复',
+}
+# 合并通知的人数按点赞表统计：(点赞模型, 对象ID列)
+COALESCED_SOURCES = {
+    'like_post': (Like, Like.post_id),
+    'like_reply': (ReplyLike, ReplyLike.reply_id),
+}
+# 已提交事务中待异步写入的通知保存在session.info中的键
+PENDING_KEY = 'pending_notifications'
+
+
+def notification_event(user_id, sender, notification_type, related_id=None, title=None):
+    """
+    构造一个通知事件
+
+    Args:
+        user_id: 接收通知的用户ID
+        sender: 触发通知的用户对象
+        notification_type: 通知类型，见NOTIFICATION_TEMPLATES
+        related_id: 关联的对象ID
+        title: 商品标题等出现在通知内容中的文本
+
+    Returns:
+        dict: 通知事件
+    """
+    return {
+        'user_id': user_id,
+        'sender_id': sender.id,
+        'sender_name': sender.username,
+        'notification_type': notification_type,
+        'related_id': related_id,
+        'title': title,
+        'date': datetime.utcnow(),
+    }
+
+
+def _content(event_data, count=1):
+    template = COALESCED_TEMPLATES[event_data['notification_type']] if count > 1 \
+        else NOTIFICATION_TEMPLATES[event_data['notification_type']]
+    return template.format(sender=event_data['sender_name'], title=event_data['title'], count=count)
+
+
+def _publish(user_id, notification_type, content, related_id, unread_delta=1):
+    # 事务提交后推送给接收者，合并到已有未读通知的不增加未读数
+    event_hub.publish_after_commit(user_id, 'notification', {
+        'notification_type': notification_type,
+        'content': content,
+        'related_id': related_id,
+        'unread_delta': unread_delta,
+    })
+
+
+def _actor_count(notification):
+    """按点赞表统计合并通知创建以来仍在点赞的人数，反复点赞/取消点赞只计一次"""
+    model, related_column = COALESCED_SOURCES[notification.notification_type]
+    return (db.session.query(db.func.count(model.id))
+            .filter(related_column == notification.related_id,
+                    model.user_id != notification.user_id,
+                    model.date_liked >= notification.date_created)
+            .scalar())
+
+
+def publish_notifications(events, coalesce_window=3600):
+    """
+    批量写入通知，并按接收者合并更新未读通知数
+
+    新通知以一条批量INSERT写入。点赞类通知在合并窗口内已有同一对象的未读通知时
+    不再新增，而是更新为"某某等N人点赞了您的帖子"，人数按点赞表统计，
+    同一用户反复点赞/取消点赞不会重复计数。
+    不提交事务，由调用方提交。
+
+    Args:
+        events: 通知事件列表，由notification_event构造
+        coalesce_window: 合并窗口（秒），从第一条点赞通知创建时开始计算
+
+    Returns:
+        int: 新增的通知数量
+    """
+    rows = []
+    groups = {}
+    for event_data in events:
+        if event_data['user_id'] == event_data['sender_id']:
+            continue
+        if event_data['notification_type'] in COALESCED_TEMPLATES:
+            key = (event_data['user_id'], event_data['notification_type'], event_data['related_id'])
+            groups.setdefault(key, []).append(event_data)
+        else:
+            rows.append(dict(event_data, count=1))
+
+    if groups:
+        # 一次查询取出合并窗口内可合并的未读通知，同一对象取最新的一条
+        cutoff = datetime.utcnow() - timedelta(seconds=coalesce_window)
+        existing = {}
+        for notification in (Notification.query
+                             .filter(Notification.user_id.in_({key[0] for key in groups}),
+                                     Notification.notification_type.in_({key[1] for key in groups}),
+                                     Notification.is_read == False,  # noqa: E712
+                                     Notification.date_created >= cutoff)
+                             .order_by(Notification.id)):
+            existing[(notification.user_id, notification.notification_type, notification.related_id)] = notification
+        for key, group in groups.items():
+            notification = existing.get(key)
+            if notification is None:
+                senders = {event_data['sender_id'] for event_data in group}
+                rows.append(dict(group[0], sender_id=group[-1]['sender_id'],
+                                 sender_name=group[-1]['sender_name'], count=len(senders)))
+                continue
+            # 保留通知的创建时间，通知列表的顺序和分页游标不受影响
+            count = max(_actor_count(notification), 1)
+            notification.sender_id = group[-1]['sender_id']
+            notification.actor_count = count
+            notification.content = _content(group[-1], count)
+            _publish(notification.user_id, notification.notification_type, notification.content,
+                     notification.related_id, unread_delta=0)
+
+    if not rows:
+        return 0
+    db.session.bulk_insert_mappings(Notification, [{
+        'user_id': row['user_id'],
+        'sender_id': row['sender_id'],
+        'notification_type': row['notification_type'],
+        'content': _content(row, row['count']),
+        'related_id': row['related_id'],
+        'actor_count': row['count'],
+        'date_created': row['date'],
+        'is_read': False,
+    } for row in rows])
+    unread = {}
+    for row in rows:
+        unread[row['user_id']] = unread.get(row['user_id'], 0) + 1
+        _publish(row['user_id'], row['notification_type'], _content(row, row['count']), row['related_id'])
+    if len(unread) == 1:
+        (user_id, delta), = unread.items()
+        bump_unread_counts(user_id, notifications=delta)
+    else:
+        # 按ID顺序批量更新，减少并发写入时的死锁概率
+        user_table = User.__table__
+        db.session.execute(
+            user_table.update()
+            .where(user_table.c.id == bindparam('b_id'))
+            .values(unread_notification_count=user_table.c.unread_notification_count + bindparam('delta')),
+            [{'b_id': user_id, 'delta': delta} for user_id, delta in sorted(unread.items())]
+        )
+    return len(rows)
+
+
+class NotificationQueue:
+    """
+    通知写入队列
+
+    NOTIFICATION_FLUSH_INTERVAL为0时，通知在业务事务中批量写入，与业务数据一起提交；
+    大于0时，通知在业务事务提交后才进入内存缓冲区（回滚的事务不会产生通知），
+    由后台线程每隔NOTIFICATION_FLUSH_INTERVAL秒合并成批量INSERT写入，
+    通知的出现最多延迟一个间隔，进程退出时再写入一次剩余的通知。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 0
+        self.coalesce_window = 3600
+        self._lock = threading.Lock()
+        self._events = []
+        self._thread = None
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        绑定应用，需要时启动后台写入线程
+
+        Args:
+            app: Flask应用实例
+        """
+        self.app = app
+        self.interval = app.config.get('NOTIFICATION_FLUSH_INTERVAL', 0)
+        self.coalesce_window = app.config.get('NOTIFICATION_COALESCE_WINDOW', 3600)
+        app.extensions['notification_queue'] = self
+        if not self._listening:
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+            atexit.register(self.flush)
+            self._listening = True
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='notification-flusher', daemon=True)
+            self._thread.start()
+
+    def emit(self, *events):
+        """
+        发送通知
+
+        不提交事务，由调用方提交；异步模式下在事务提交后才进入缓冲区。
+
+        Args:
+            events: 通知事件，由notification_event构造
+        """
+        if self.interval > 0:
+            db.session.info.setdefault(PENDING_KEY, []).extend(events)
+        else:
+            publish_notifications(events, self.coalesce_window)
+
+    def _after_commit(self, session):
+        events = session.info.pop(PENDING_KEY, None)
+        if events:
+            with self._lock:
+                self._events.extend(events)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop(PENDING_KEY, None)
+
+    def flush(self):
+        """
+        将缓冲的通知批量写入数据库
+
+        Returns:
+            int: 新增的通知数量
+        """
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return 0
+        with self.app.app_context():
+            try:
+                count = publish_notifications(events, self.coalesce_window)
+                db.session.commit()
+                return count
+            except Exception as e:
+                # 写入失败时把通知放回缓冲区，等待下次写入重试
+                db.session.rollback()
+                with self._lock:
+                    self._events[:0] = events
+                print(f"通知写入失败: {e}")
+                return 0
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+# 全局通知队列，由app/__init__.py统一初始化
+notification_queue = NotificationQueue()
+
+
+def mark_notification_read(notification):
+    """
+    将通知以及同一对象的同类未读通知标记为已读，并同步减少未读通知数
+
+    以一条UPDATE批量标记，未读通知数按实际标记的条数扣减；
+    并发的重复点击只有一次能标记成功，不会重复扣减。
+    不提交事务，由调用方提交。
+
+    Args:
+        notification: 通知对象
+
+    Returns:
+        int: 标记为已读的通知数量
+    """
+    count = Notification.query.filter(
+        Notification.user_id == notification.user_id,
+        Notification.notification_type == notification.notification_type,
+        Notification.related_id == notification.related_id,
+        Notification.is_read == False  # noqa: E712
+    ).update({Notification.is_read: True}, synchronize_session='evaluate')
+    if count:
+        bump_unread_counts(notification.user_id, notifications=-count)
+    return count
+
+
+def clear_unread_notifications(user_id):
+    """
+    将用户的所有未读通知标记为已读，并清零未读通知数
+
+    不提交事务，由调用方提交。
+
+    Args:
+        user_id: 用户ID
+    """
+    Notification.query.filter_by(user_id=user_id, is_read=False).update({'is_read': True})
+    User.query.filter_by(id=user_id).update({'unread_notification_count': 0}, synchronize_session='fetch')
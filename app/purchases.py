@@ -0,0 +1,161 @@
+import time
+import random
+
+from sqlalchemy.exc import DBAPIError
+
+from .models import db, Item, Stock, Order, Notification
+from .counters import HOTNESS_SALES_WEIGHT, bump_user_counters
+from .notifications import notification_queue, notification_event
+from .uploads import retain_picture
+
+
+class PurchaseError(Exception):
+    """购买失败（库存不足、数量无效等），异常信息可直接提示给用户"""
+
+
+def _is_retryable(error):
+    """判断数据库错误是否为可重试的死锁或锁等待超时"""
+    message = str(getattr(error, 'orig', error)).lower()
+    # SQL Server死锁为1205，锁请求超时为1222；SQLite为database is locked
+    return 'deadlock' in message or '1205' in message or '1222' in message or 'database is locked' in message
+
+
+def _purchase_once(buyer, item_id, quantity):
+    # 1. 条件扣减库存：库存不足时不更新任何行，不会超卖；同一语句累加销量和热度
+    updated = Item.query.filter(Item.id == item_id, Item.stock >= quantity).update({
+        Item.stock: Item.stock - quantity,
+        Item.sales_count: Item.sales_count + quantity,
+        Item.hotness: Item.hotness + quantity * HOTNESS_SALES_WEIGHT,
+    }, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        raise PurchaseError('商品库存不足！')
+
+    # 已持有商品行的锁，此时读取的是扣减后的数据
+    item = Item.query.populate_existing().get(item_id)
+
+    # 2. 更新卖家成交量
+    bump_user_counters(item.user_id, sales=1)
+
+    # 3. 添加商品到买家库存，已有同名库存时增加数量
+    updated = Stock.query.filter_by(user_id=buyer.id, name=item.title).update(
+        {Stock.quantity: Stock.quantity + quantity}, synchronize_session=False
+    )
+    if not updated:
+        db.session.add(Stock(
+            name=item.title,
+            quantity=quantity,
+            description=item.description,
+            image_file=item.image_file,
+            user_id=buyer.id
+        ))
+        retain_picture(item.image_file)
+
+    # 4. 记录订单，保存成交时的数量和单价
+    order = Order(
+        buyer_id=buyer.id,
+        seller_id=item.user_id,
+        item_id=item.id,
+        item_title=item.title,
+        quantity=quantity,
+        unit_price=item.price
+    )
+    db.session.add(order)
+    db.session.flush()
+
+    # 5. 发送购买通知给卖家，通知关联订单
+    notification_queue.emit(notification_event(item.user_id, buyer, 'buy_item', order.id, title=item.title))
+    db.session.commit()
+    return order
+
+
+def purchase_item(buyer, item_id, quantity, max_retries=3):
+    """
+    购买商品
+
+    库存以条件UPDATE原子扣减，计数器均为单条语句增量更新，同时写入订单记录。
+    事务内先锁商品行再写其他表，持锁时间短且加锁顺序一致。遇到死锁或锁超时时回滚并重试。
+    与其他写操作不同，本函数自行提交事务，以便在提交阶段发生死锁时也能重试。
+
+    Args:
+        buyer: 买家用户对象
+        item_id: 商品ID
+        quantity: 购买数量
+        max_retries: 死锁时的最大重试次数
+
+    Returns:
+        Order: 新建的订单对象
+
+    Raises:
+        PurchaseError: 库存不足或购买数量无效
+    """
+    if quantity < 1:
+        raise PurchaseError('购买数量无效！')
+    for attempt in range(max_retries + 1):
+        try:
+            return _purchase_once(buyer, item_id, quantity)
+        except DBAPIError as e:
+            db.session.rollback()
+            if attempt == max_retries or not _is_retryable(e):
+                raise
+            # 随机退避，避免冲突的事务同时重试再次死锁
+            time.sleep(random.uniform(0.01, 0.05) * 2 ** attempt)
+
+
+def _order_conditions(notification):
+    """
+    购买通知关联订单的条件：订单ID、买卖双方一致，且订单不晚于通知创建
+
+    旧通知的related_id是商品ID，可能恰好等于另一个订单的ID，需同时核对买卖双方。
+    notification可以是Notification模型（用于查询）或通知对象。
+    """
+    return (Order.id == notification.related_id,
+            Order.seller_id == notification.user_id,
+            Order.buyer_id == notification.sender_id,
+            Order.date_created <= notification.date_created)
+
+
+def get_notification_order(notification):
+    """
+    获取购买通知关联的订单
+
+    Args:
+        notification: buy_item类型的通知
+
+    Returns:
+        Order: 关联的订单；尚未由backfill-orders补录的旧通知返回None
+    """
+    return Order.query.filter(*_order_conditions(notification)).first()
+
+
+def backfill_orders():
+    """
+    为上线订单表之前的购买通知补录订单，并把通知改为关联订单
+
+    旧通知中没有记录购买数量和成交价，补录的订单数量记为1，单价取商品当前价格；
+    商品已删除的订单单价记为0。
+
+    Returns:
+        int: 补录的订单数量
+    """
+    linked = db.session.query(Order.id).filter(*_order_conditions(Notification)).exists()
+    rows = (db.session.query(Notification, Item)
+            .outerjoin(Item, Item.id == Notification.related_id)
+            .filter(Notification.notification_type == 'buy_item', ~linked)
+            .order_by(Notification.id)
+            .all())
+    for notification, item in rows:
+        order = Order(
+            buyer_id=notification.sender_id,
+            seller_id=notification.user_id,
+            item_id=item.id if item else None,
+            item_title=item.title if item else '已删除的商品',
+            quantity=1,
+            unit_price=item.price if item else 0,
+            date_created=notification.date_created
+        )
+        db.session.add(order)
+        db.session.flush()
+        notification.related_id = order.id
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,97 @@
+import heapq
+import math
+from itertools import groupby
+
+from sqlalchemy import and_, func, literal, select, union_all
+from sqlalchemy.orm import joinedload
+
+from .models import db, Item, Follow, Order, ItemSimilarity
+
+
+def _signals(purchase_weight, max_user_signals):
+    """
+    用户×商品稀疏矩阵的非零元素，每行为(user_id, item_id, weight)
+
+    关注记为1，购买记为purchase_weight，同一用户对同一商品只取较大的权重；
+    关注和购买的商品超过max_user_signals个的用户不参与计算。
+    """
+    raw = union_all(
+        select(Follow.user_id.label('user_id'), Follow.item_id.label('item_id'), literal(1).label('weight')),
+        select(Order.buyer_id, Order.item_id, literal(purchase_weight)).where(Order.item_id.isnot(None)),
+    ).subquery()
+    cells = (select(raw.c.user_id, raw.c.item_id, func.max(raw.c.weight).label('weight'))
+             .group_by(raw.c.user_id, raw.c.item_id)
+             .subquery())
+    active_users = (select(cells.c.user_id)
+                    .group_by(cells.c.user_id)
+                    .having(func.count() <= max_user_signals))
+    return select(cells.c.user_id, cells.c.item_id, cells.c.weight).where(cells.c.user_id.in_(active_users))
+
+
+def refresh_recommendations(top_k=10, max_user_signals=500, purchase_weight=2):
+    """
+    根据关注和购买记录重新计算每个商品的前top_k个相似商品并写入快照表
+
+    相似度为两个商品在用户×商品矩阵中列向量的余弦相似度。矩阵的稀疏乘积
+    （同一用户关注或购买过的商品对及其权重积之和）由数据库按商品对分组计算，
+    只有共现过的商品对会被返回；程序按商品逐组读取结果，除以两个商品的向量长度
+    后用堆保留前top_k个，不在内存中构造整个矩阵。
+
+    Args:
+        top_k: 每个商品保留的相似商品数
+        max_user_signals: 参与计算的用户最多关注和购买的商品数
+        purchase_weight: 购买记录相对关注的权重
+
+    Returns:
+        int: 写入的相似商品记录数
+    """
+    signals = _signals(purchase_weight, max_user_signals)
+    norm_source = signals.subquery()
+    norms = {
+        item_id: math.sqrt(total)
+        for item_id, total in db.session.execute(
+            select(norm_source.c.item_id, func.sum(norm_source.c.weight * norm_source.c.weight))
+            .group_by(norm_source.c.item_id)
+        )
+    }
+    a = signals.subquery('a')
+    b = signals.subquery('b')
+    pairs = (select(a.c.item_id, b.c.item_id, func.sum(a.c.weight * b.c.weight))
+             .join(b, and_(a.c.user_id == b.c.user_id, a.c.item_id != b.c.item_id))
+             .group_by(a.c.item_id, b.c.item_id)
+             .order_by(a.c.item_id))
+    rows = []
+    result = db.session.execute(pairs, execution_options={'yield_per': 1000})
+    for item_id, group in groupby(result, key=lambda row: row[0]):
+        best = heapq.nlargest(top_k, (
+            (dot / (norms[item_id] * norms[similar_item_id]), similar_item_id)
+            for _, similar_item_id, dot in group
+        ))
+        rows.extend(
+            {'item_id': item_id, 'similar_item_id': similar_item_id, 'rank': rank, 'score': score}
+            for rank, (score, similar_item_id) in enumerate(best, start=1)
+        )
+    ItemSimilarity.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(ItemSimilarity, rows)
+    db.session.commit()
+    return len(rows)
+
+
+def get_similar_items(item_id, limit=10):
+    """
+    按名次读取商品的相似商品，已删除和已售罄的商品不显示
+
+    Args:
+        item_id: 商品ID
+        limit: 返回条数
+
+    Returns:
+        list: Item对象列表，卖家一并加载
+    """
+    return (Item.query
+            .options(joinedload(Item.seller))
+            .join(ItemSimilarity, ItemSimilarity.similar_item_id == Item.id)
+            .filter(ItemSimilarity.item_id == item_id, Item.stock > 0)
+            .order_by(ItemSimilarity.rank.asc())
+            .limit(limit)
+            .all())
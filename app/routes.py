@@ -1,17 +1,41 @@
-from flask import Blueprint, render_template, url_for, flash, redirect, request, abort, jsonify
+from flask import Blueprint, render_template, url_for, flash, redirect, request, abort, jsonify, current_app, Response
 from flask_login import login_user, current_user, logout_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import traceback
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 
-from .models import db, User, Item, Follow, Request, Post, Like, ReplyLike, UserFollow, Reply, Message, Notification, Stock, Comment, CommentReply, CommentLike
+from .models import db, User, Item, Follow, Request, Post, Like, ReplyLike, UserFollow, Reply, Message, Notification, Stock, Comment, CommentReply, CommentLike, Order
 from .forms import RegistrationForm, LoginForm, ItemForm, ProfileForm, RequestForm, PostForm, ReplyForm, StockForm, CommentForm, CommentReplyForm
-from .utils import save_picture, format_content, get_pagination_data
+from .utils import save_picture, upload_url, format_content, get_pagination_data, get_keyset_page, get_offset_page, encode_cursor
+from .uploads import retain_picture, release_picture, send_upload
+from .counters import bump_item_counters, bump_user_counters
+from .leaderboard import get_leaderboard
+from .view_counter import view_counter
+from .conversations import send_message, get_conversations, mark_thread_read, thread_condition
+from .notifications import notification_queue, notification_event, mark_notification_read, clear_unread_notifications
+from .search import apply_search, index_document, remove_document
+from .image_pipeline import image_pipeline
+from .cache import fragment_cache
+from .purchases import purchase_item, get_notification_order, PurchaseError
+from .events import event_hub
+from .follow_graph import add_follow, remove_follow, follow_state, follow_relations, following_ids
+from .recommendations import get_similar_items
+from .timelines import fan_out, remove_from_timelines, backfill_timeline, backfill_followers, remove_author, timeline_query, load_timeline_items
+from .matching import match_listing, index_listing, remove_listing
 
 # 创建蓝图对象
 main = Blueprint('main', __name__)
 
 
+@image_pipeline.on_ready
+def _expire_market_images(relative_path):
+    """商品图片处理完成后使商品列表缓存失效，缓存中不会长期保留处理期间显示的默认图片"""
+    if not relative_path.startswith('avatars/'):
+        fragment_cache.bump('market')
+
+
 # --- 路由逻辑 --- 
 @main.route("/")
 def welcome():
@@ -24,59 +48,81 @@ def market():
     sort_by = request.args.get('sort_by', 'latest')
     # 获取搜索参数
     search_query = request.args.get('search', '')
-    # 获取页码
-    page = request.args.get('page', 1, type=int)
     
-    # 基础查询
-    query = Item.query
-    
-    # 应用搜索过滤
-    if search_query:
-        # 完全避免使用LOWER函数，直接使用LIKE操作符
-        # 虽然这可能导致区分大小写，但可以避免SQL Server TEXT类型问题
-        search_pattern = f'%{search_query}%'
-        query = query.filter(
-            Item.title.like(search_pattern) | 
-            Item.description.like(search_pattern)
-        )
+    # 搜索时未指定排序方式则按相关度排序
+    if search_query and 'sort_by' not in request.args:
+        sort_by = 'relevance'
     
-    # 应用排序
-    if sort_by == 'latest':
-        query = query.order_by(Item.date_posted.desc())
-    elif sort_by == 'most_followed':
-        # 使用外连接确保没有关注者的商品也能显示
-        from .models import Follow
-        # SQL Server要求所有非聚合列必须在GROUP BY中，使用子查询方式计算关注数
-        from sqlalchemy import func
-        subquery = db.session.query(Follow.item_id, func.count(Follow.id).label('follow_count')).group_by(Follow.item_id).subquery()
-        query = query.outerjoin(subquery, Item.id == subquery.c.item_id).order_by(func.coalesce(subquery.c.follow_count, 0).desc())
-    elif sort_by == 'most_viewed':
-        query = query.order_by(Item.views.desc())
-    elif sort_by == 'hottest':
-        # 热度 = 浏览量 * 0.5 + 关注数 * 2 + 销量 * 5
-        from .models import Follow
-        from sqlalchemy import func
-        # 使用子查询计算关注数
-        subquery = db.session.query(Follow.item_id, func.count(Follow.id).label('follow_count')).group_by(Follow.item_id).subquery()
-        # 热度排序，使用COALESCE确保没有关注者的商品热度计算正确
-        query = query.outerjoin(subquery, Item.id == subquery.c.item_id).order_by(
-            (Item.views * 0.5 + func.coalesce(subquery.c.follow_count, 0) * 2 + Item.sales_count * 5).desc()
-        )
-    elif sort_by == 'best_selling':
-        query = query.order_by(Item.sales_count.desc())
-    elif sort_by == 'price_asc':
-        query = query.order_by(Item.price.asc())
-    elif sort_by == 'price_desc':
-        query = query.order_by(Item.price.desc())
-    else:
-        # 默认按最新排序
-        query = query.order_by(Item.date_posted.desc())
+    # 商品列表与当前用户无关，按排序、搜索和翻页参数缓存渲染结果，
+    # 命中时不再查询数据库；商品发布、修改、删除和售出时更新版本戳使缓存失效
+    def render_listing():
+        pagination = _market_page(sort_by, search_query, per_page=12)
+        return render_template('market_items.html', items=pagination.items, current_sort=sort_by, search_query=search_query, pagination=pagination)
     
-    # 应用分页
-    pagination, items = get_pagination_data(query, page, per_page=12)
+    key_parts = (sort_by, search_query, request.args.get('after'), request.args.get('before'),
+                 request.args.get('page'))
+    listing = fragment_cache.get_or_render('market', key_parts, render_listing)
     
     # 渲染模板
-    return render_template('index.html', items=items, current_sort=sort_by, search_query=search_query, pagination=pagination)
+    return render_template('index.html', listing=listing, current_sort=sort_by, search_query=search_query)
+
+
+# 商品市场各排序方式对应的游标列，最后一列为id保证顺序唯一
+# 热度 = 浏览量 * 0.5 + 关注数 * 2 + 销量 * 5，由计数器增量维护；关注数使用冗余列，避免对Follow表做GROUP BY
+MARKET_SORT_KEYS = {
+    'latest': [(Item.date_posted, True), (Item.id, True)],
+    'most_followed': [(Item.follow_count, True), (Item.id, True)],
+    'most_viewed': [(Item.views, True), (Item.id, True)],
+    'hottest': [(Item.hotness, True), (Item.id, True)],
+    'best_selling': [(Item.sales_count, True), (Item.id, True)],
+    'price_asc': [(Item.price, False), (Item.id, False)],
+    'price_desc': [(Item.price, True), (Item.id, True)],
+}
+
+
+def _market_page(sort_by, search_query, per_page):
+    """按排序方式和搜索条件获取一页商品，商品页面和无限滚动接口共用"""
+    # 卖家一并加载，商品卡片显示卖家用户名
+    query = Item.query.options(joinedload(Item.seller))
+    count_key = ('market', search_query)
+    
+    if search_query and sort_by == 'relevance':
+        # 相关度由搜索后端计算，无法按列定位，使用页码分页；最新发布的排在同分商品前
+        query = apply_search(query, 'item', search_query, rank=True).order_by(Item.date_posted.desc(), Item.id.desc())
+        page = request.args.get('page', 1, type=int)
+        return get_offset_page(query, page, per_page=per_page, count_key=count_key)
+    
+    if search_query:
+        query = apply_search(query, 'item', search_query)
+    # 未知的排序方式按最新排序
+    keys = MARKET_SORT_KEYS.get(sort_by, MARKET_SORT_KEYS['latest'])
+    return get_keyset_page(query, keys, after=request.args.get('after'), before=request.args.get('before'),
+                           per_page=per_page, count_key=count_key)
+
+
+@main.route("/api/market/items")
+def market_items_api():
+    """商品列表无限滚动接口，参数与/market相同，通过after游标加载下一页"""
+    sort_by = request.args.get('sort_by', 'latest')
+    search_query = request.args.get('search', '')
+    if search_query and 'sort_by' not in request.args:
+        sort_by = 'relevance'
+    pagination = _market_page(sort_by, search_query, per_page=12)
+    return jsonify({
+        'items': [{
+            'id': item.id,
+            'title': item.title,
+            'price': item.price,
+            'stock': item.stock,
+            'views': item.views,
+            'follow_count': item.follow_count,
+            'image_url': upload_url(item.image_file, size='thumb'),
+            'image_webp_url': upload_url(item.image_file, size='thumb', webp=True),
+            'url': url_for('main.item_detail', item_id=item.id),
+        } for item in pagination.items],
+        'next': url_for('main.market_items_api', sort_by=sort_by, search=search_query, **pagination.next_args) if pagination.has_next else None,
+        'total': pagination.total,
+    })
 
 
 @main.route("/test")
@@ -170,7 +216,12 @@ def new_item():
         
         # 保存商品到数据库
         db.session.add(item)
+        bump_user_counters(current_user.id, items=1)
+        index_document(item)
+        fan_out(item)
+        match_listing(item, current_user)
         db.session.commit()
+        fragment_cache.bump('market')
         flash('商品发布成功！', 'success')
         return redirect(url_for('main.market'))
     
@@ -214,24 +265,26 @@ def add_stock_item():
         image_file=stock_item.image_file,
         seller=current_user
     )
+    # 商品与库存物品共用同一张图片
+    retain_picture(item.image_file)
     
     # 更新库存数量
     stock_item.quantity -= stock_quantity
     
     # 如果库存数量为0，删除库存物品
     if stock_item.quantity == 0:
-        # 删除库存物品的图片（如果不是默认图片）
-        if stock_item.image_file != 'default.jpg':
-            from flask import current_app
-            import os
-            picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], stock_item.image_file)
-            if os.path.exists(picture_path):
-                os.remove(picture_path)
+        # 释放库存物品对图片的引用，新商品仍在使用该图片
+        release_picture(stock_item.image_file)
         db.session.delete(stock_item)
     
     # 保存商品到数据库
     db.session.add(item)
+    bump_user_counters(current_user.id, items=1)
+    index_document(item)
+    fan_out(item)
+    match_listing(item, current_user)
     db.session.commit()
+    fragment_cache.bump('market')
     flash('商品发布成功！', 'success')
     return redirect(url_for('main.market'))
 
@@ -239,8 +292,8 @@ def add_stock_item():
 @main.route("/item/<int:item_id>", methods=['GET', 'POST'])
 def item_detail(item_id):
     item = Item.query.get_or_404(item_id)
-    item.views += 1
-    db.session.commit()
+    # 浏览量先写入内存缓冲区，由后台线程批量落库
+    view_counter.record_item(item.id)
     
     # 评论表单
     comment_form = CommentForm()
@@ -266,8 +319,11 @@ def item_detail(item_id):
     
     # 获取商品的所有评论，按时间倒序排列
     comments = Comment.query.filter_by(item_id=item.id).order_by(Comment.date_posted.desc()).all()
+    # 相似商品由refresh-recommendations离线计算，这里只按名次读取快照
+    similar_items = get_similar_items(item.id, current_app.config['RECOMMENDATION_TOP_K'])
     
-    return render_template('item_detail.html', title=item.title, item=item, comment_form=comment_form, comments=comments)
+    return render_template('item_detail.html', title=item.title, item=item, comment_form=comment_form, comments=comments,
+                           similar_items=similar_items)
 
 
 @main.route("/item/<int:item_id>/delete", methods=['POST'])
@@ -276,8 +332,14 @@ def delete_item(item_id):
     item = Item.query.get_or_404(item_id)
     if item.seller != current_user and not current_user.is_admin:
         abort(403)
+    remove_document(item)
+    remove_from_timelines(item)
+    remove_listing(item)
+    release_picture(item.image_file)
+    bump_user_counters(item.user_id, items=-1)
     db.session.delete(item)
     db.session.commit()
+    fragment_cache.bump('market')
     flash('商品已删除', 'success')
     return redirect(url_for('main.profile'))
 
@@ -297,16 +359,12 @@ def follow_item(item_id):
         try:
             follow = Follow(user_id=current_user.id, item_id=item.id)
             db.session.add(follow)
+            bump_item_counters(item.id, follows=1)
             
             # 添加关注商品通知
-            notification = Notification(
-                user_id=item.user_id,
-                sender_id=current_user.id,
-                notification_type='follow_item',
-                content=f'{current_user.username} 关注了您的商品 "{item.title}"',
-                related_id=item.id
+            notification_queue.emit(
+                notification_event(item.user_id, current_user, 'follow_item', item.id, title=item.title)
             )
-            db.session.add(notification)
             
             db.session.commit()
             flash('已成功关注该商品', 'success')
@@ -325,6 +383,7 @@ def unfollow_item(item_id):
     follow = Follow.query.filter_by(user_id=current_user.id, item_id=item.id).first()
     if follow:
         db.session.delete(follow)
+        bump_item_counters(item.id, follows=-1)
         db.session.commit()
         flash('已取消关注该商品', 'success')
     # 不重定向，直接返回响应，让AJAX处理
@@ -334,22 +393,10 @@ def unfollow_item(item_id):
 @main.route("/profile")
 @login_required
 def profile():
-    """个人中心路由"""
+    """个人中心路由，页面只渲染头部信息，各标签页内容由profile_tab按需分页加载"""
     # 创建库存表单对象
     form = StockForm()
-    # 获取当前用户发布的所有商品
-    user_items = Item.query.filter_by(user_id=current_user.id).order_by(Item.date_posted.desc()).all()
-    # 获取当前用户关注的所有商品
-    followed_items = Item.query.join(Follow).filter(Follow.user_id == current_user.id).order_by(Follow.date_followed.desc()).all()
-    # 获取当前用户发布的所有求购信息
-    user_requests = Request.query.filter_by(user_id=current_user.id).order_by(Request.date_posted.desc()).all()
-    # 获取当前用户发布的所有帖子
-    user_posts = Post.query.filter_by(user_id=current_user.id).order_by(Post.date_posted.desc()).all()
-    # 获取当前用户发布的所有回复
-    user_replies = Reply.query.filter_by(user_id=current_user.id).order_by(Reply.date_posted.desc()).all()
-    # 获取当前用户的所有库存物品
-    user_stocks = Stock.query.filter_by(user_id=current_user.id).order_by(Stock.date_added.desc()).all()
-    return render_template('profile.html', title='个人中心', user=current_user, items=user_items, followed_items=followed_items, requests=user_requests, posts=user_posts, replies=user_replies, stocks=user_stocks, form=form)
+    return render_template('profile.html', title='个人中心', user=current_user, form=form)
 
 
 @main.route("/profile/edit", methods=['GET', 'POST'])
@@ -366,13 +413,9 @@ def edit_profile():
         # 处理头像上传
         if form.avatar.data:
             avatar_file = save_picture(form.avatar.data, is_avatar=True)
-            # 删除旧头像（如果不是默认头像）
+            # 释放旧头像的引用（如果不是默认头像）
             if current_user.avatar != 'default_avatar.png':
-                from flask import current_app
-                import os
-                old_avatar_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'avatars', current_user.avatar)
-                if os.path.exists(old_avatar_path):
-                    os.remove(old_avatar_path)
+                release_picture(current_user.avatar, is_avatar=True)
             current_user.avatar = avatar_file
         
         # 处理密码修改
@@ -425,16 +468,15 @@ def update_item(item_id):
         # 处理图片更新
         if form.picture.data:
             picture_file = save_picture(form.picture.data, is_avatar=False)
-            # 删除旧图片（如果不是默认图片）
+            # 释放旧图片的引用（如果不是默认图片）
             if item.image_file != 'default.jpg':
-                from flask import current_app
-                import os
-                old_picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], item.image_file)
-                if os.path.exists(old_picture_path):
-                    os.remove(old_picture_path)
+                release_picture(item.image_file)
             item.image_file = picture_file
         
+        index_document(item)
+        index_listing(item)
         db.session.commit()
+        fragment_cache.bump('market')
         flash('商品信息已成功更新！', 'success')
         return redirect(url_for('main.profile'))
     elif request.method == 'GET':
@@ -458,15 +500,9 @@ def requests():
     # 基础查询
     query = Request.query
     
-    # 应用搜索过滤
+    # 应用搜索过滤，搜索结果按相关度排序
     if search_query:
-        # 完全避免使用LOWER函数，直接使用LIKE操作符
-        # 虽然这可能导致区分大小写，但可以避免SQL Server TEXT类型问题
-        search_pattern = f'%{search_query}%'
-        query = query.filter(
-            Request.title.like(search_pattern) | 
-            Request.description.like(search_pattern)
-        )
+        query = apply_search(query, 'request', search_query, rank=True)
     
     # 按最新排序
     query = query.order_by(Request.date_posted.desc())
@@ -488,6 +524,9 @@ def new_request():
         request_item = Request(title=form.title.data, description=form.description.data, 
                           price=form.price.data, image_file=pic_file, user=current_user)
         db.session.add(request_item)
+        index_document(request_item)
+        fan_out(request_item)
+        match_listing(request_item, current_user)
         db.session.commit()
         flash('求购信息发布成功！', 'success')
         return redirect(url_for('main.requests'))
@@ -518,15 +557,13 @@ def update_request(request_id):
         # 处理图片更新
         if form.picture.data:
             pic_file = save_picture(form.picture.data, is_avatar=False)
-            # 删除旧图片（如果不是默认图片）
+            # 释放旧图片的引用（如果不是默认图片）
             if req.image_file != 'default.jpg':
-                from flask import current_app
-                import os
-                old_pic_path = os.path.join(current_app.config['UPLOAD_FOLDER'], req.image_file)
-                if os.path.exists(old_pic_path):
-                    os.remove(old_pic_path)
+                release_picture(req.image_file)
             req.image_file = pic_file
         
+        index_document(req)
+        index_listing(req)
         db.session.commit()
         flash('求购信息已成功更新！', 'success')
         return redirect(url_for('main.requests'))
@@ -547,14 +584,13 @@ def delete_request(request_id):
         flash('您没有权限删除此求购信息！', 'danger')
         return redirect(url_for('main.requests'))
     
-    # 删除求购信息对应的图片（如果不是默认图片）
+    # 释放求购信息对图片的引用（如果不是默认图片）
     if req.image_file != 'default.jpg':
-        from flask import current_app
-        import os
-        pic_path = os.path.join(current_app.config['UPLOAD_FOLDER'], req.image_file)
-        if os.path.exists(pic_path):
-            os.remove(pic_path)
+        release_picture(req.image_file)
     
+    remove_document(req)
+    remove_from_timelines(req)
+    remove_listing(req)
     db.session.delete(req)
     db.session.commit()
     flash('求购信息已删除', 'success')
@@ -570,21 +606,14 @@ def follow_user(user_id):
         flash('您不能关注自己！', 'danger')
         return redirect(url_for('main.user_profile', user_id=user_id))
     
-    # 检查是否已经关注
-    follow = UserFollow.query.filter_by(follower_id=current_user.id, followed_id=user_id).first()
-    if not follow:
-        follow = UserFollow(follower_id=current_user.id, followed_id=user_id)
-        db.session.add(follow)
-        
+    # 已关注时不重复写入，也不重复发送通知
+    if add_follow(current_user.id, user.id):
+        # 把对方最近发布的内容补入关注动态
+        backfill_timeline(current_user.id, user.id)
         # 添加关注通知
-        notification = Notification(
-            user_id=user.id,
-            sender_id=current_user.id,
-            notification_type='follow_user',
-            content=f'{current_user.username} 关注了您',
-            related_id=current_user.id
+        notification_queue.emit(
+            notification_event(user.id, current_user, 'follow_user', current_user.id)
         )
-        db.session.add(notification)
         
         db.session.commit()
         flash(f'您已成功关注 {user.username}！', 'success')
@@ -596,14 +625,87 @@ def follow_user(user_id):
 @login_required
 def unfollow_user(user_id):
     user = User.query.get_or_404(user_id)
-    follow = UserFollow.query.filter_by(follower_id=current_user.id, followed_id=user_id).first()
-    if follow:
-        db.session.delete(follow)
+    if remove_follow(current_user.id, user.id):
+        remove_author(current_user.id, user.id)
+        # 对方粉丝数降回上限时，补入未写入粉丝时间线的内容
+        backfill_followers(user.id)
         db.session.commit()
         flash(f'您已取消关注 {user.username}！', 'success')
     return redirect(request.referrer or url_for('main.user_profile', user_id=user_id))
 
 
+# 关注动态路由
+@main.route("/feed")
+@login_required
+def following_feed():
+    """关注的用户最近发布的商品、求购和帖子，从时间线表按游标分页读取"""
+    query, keys = timeline_query(current_user.id)
+    pagination = get_keyset_page(query, keys, after=request.args.get('after'),
+                                 before=request.args.get('before'), per_page=20)
+    entries = load_timeline_items(pagination.items)
+    return render_template('feed.html', title='关注动态', entries=entries, pagination=pagination)
+
+
+def _prefetch_square_data(posts, user_id):
+    """
+    以固定数量的批量查询获取交流广场一页帖子所需的全部关联数据
+
+    Args:
+        posts: 当前页的帖子列表
+        user_id: 当前用户ID
+
+    Returns:
+        dict: 帖子ID -> {'like_count', 'liked', 'replies'}，
+              replies为按时间升序的[{'reply', 'like_count', 'liked'}]
+    """
+    post_ids = [post.id for post in posts]
+    if not post_ids:
+        return {}
+    
+    # 帖子点赞数和当前用户的点赞状态
+    post_like_counts = dict(db.session.query(Like.post_id, func.count(Like.id))
+                            .filter(Like.post_id.in_(post_ids))
+                            .group_by(Like.post_id).all())
+    post_liked = {row[0] for row in db.session.query(Like.post_id)
+                  .filter(Like.user_id == user_id, Like.post_id.in_(post_ids)).all()}
+    
+    # 回复及其作者、被引用的回复/帖子的作者
+    replies = (Reply.query
+               .filter(Reply.post_id.in_(post_ids))
+               .options(joinedload(Reply.user),
+                        joinedload(Reply.quoted_reply).joinedload(Reply.user),
+                        joinedload(Reply.quoted_post).joinedload(Post.user))
+               .order_by(Reply.date_posted.asc())
+               .all())
+    reply_ids = [reply.id for reply in replies]
+    
+    # 回复点赞数和当前用户的点赞状态
+    reply_like_counts = {}
+    reply_liked = set()
+    if reply_ids:
+        reply_like_counts = dict(db.session.query(ReplyLike.reply_id, func.count(ReplyLike.id))
+                                 .filter(ReplyLike.reply_id.in_(reply_ids))
+                                 .group_by(ReplyLike.reply_id).all())
+        reply_liked = {row[0] for row in db.session.query(ReplyLike.reply_id)
+                       .filter(ReplyLike.user_id == user_id, ReplyLike.reply_id.in_(reply_ids)).all()}
+    
+    square_data = {
+        post_id: {
+            'like_count': post_like_counts.get(post_id, 0),
+            'liked': post_id in post_liked,
+            'replies': []
+        }
+        for post_id in post_ids
+    }
+    for reply in replies:
+        square_data[reply.post_id]['replies'].append({
+            'reply': reply,
+            'like_count': reply_like_counts.get(reply.id, 0),
+            'liked': reply.id in reply_liked
+        })
+    return square_data
+
+
 # 交流广场路由
 @main.route("/square", methods=['GET', 'POST'])
 @login_required
@@ -614,28 +716,27 @@ def square():
     # 获取搜索参数
     search_query = request.args.get('search', '')
     search_type = request.args.get('search_type', 'content')
-    # 获取页码
-    page = request.args.get('page', 1, type=int)
-    
     # 根据搜索参数和类型过滤帖子
     if search_query:
-        # 完全避免使用LOWER函数，直接使用LIKE操作符
-        # 虽然这可能导致区分大小写，但可以避免SQL Server TEXT类型问题
-        search_pattern = f'%{search_query}%'
         if search_type == 'user':
             # 搜索用户发言（根据用户名搜索）
+            search_pattern = f'%{search_query}%'
             query = Post.query.join(User).filter(User.username.like(search_pattern))
         else:
-            # 搜索发言内容
-            query = Post.query.filter(Post.content.like(search_pattern))
+            # 搜索发言内容（通过搜索索引匹配，仍按时间排列）
+            query = apply_search(Post.query, 'post', search_query)
     else:
         query = Post.query
     
-    # 按时间升序排列，使新消息显示在底部
-    query = query.order_by(Post.date_posted.asc())
+    # 按游标分页，默认显示最新的20条，通过after游标向前加载更早的留言；发帖人一并加载
+    query = query.options(joinedload(Post.user))
+    pagination = get_keyset_page(query, [(Post.date_posted, True), (Post.id, True)],
+                                 after=request.args.get('after'), before=request.args.get('before'), per_page=20)
+    # 按时间升序显示，使新消息显示在底部
+    posts = pagination.items[::-1]
     
-    # 应用分页
-    pagination, posts = get_pagination_data(query, page, per_page=20)
+    # 批量预取点赞数、点赞状态和回复，模板不再逐条查询
+    square_data = _prefetch_square_data(posts, current_user.id)
     
     # 为每条帖子创建一个回复表单
     for post in posts:
@@ -650,12 +751,14 @@ def square():
         # 创建新留言
         post = Post(content=form.content.data, image_file=image_file, user=current_user)
         db.session.add(post)
+        index_document(post)
+        fan_out(post)
         db.session.commit()
         flash('留言发布成功！', 'success')
         return redirect(url_for('main.square', new_message='true'))
     
     # 将Reply模型和搜索参数传递给模板上下文
-    return render_template('square.html', title='交流广场', form=form, posts=posts, reply_forms=reply_forms, Reply=Reply, search_query=search_query, search_type=search_type, pagination=pagination)
+    return render_template('square.html', title='交流广场', form=form, posts=posts, square_data=square_data, reply_forms=reply_forms, search_query=search_query, search_type=search_type, pagination=pagination)
 
 
 # 点赞路由
@@ -675,16 +778,11 @@ def like_post(post_id):
         like = Like(user_id=current_user.id, post_id=post_id)
         db.session.add(like)
         
-        # 添加点赞通知
+        # 添加点赞通知，短时间内的多次点赞合并为一条
         if post.user_id != current_user.id:
-            notification = Notification(
-                user_id=post.user_id,
-                sender_id=current_user.id,
-                notification_type='like_post',
-                content=f'{current_user.username} 点赞了您的帖子',
-                related_id=post.id
+            notification_queue.emit(
+                notification_event(post.user_id, current_user, 'like_post', post.id)
             )
-            db.session.add(notification)
         
         flash('点赞成功！', 'success')
     
@@ -709,16 +807,11 @@ def like_reply(reply_id):
         like = ReplyLike(user_id=current_user.id, reply_id=reply_id)
         db.session.add(like)
         
-        # 添加回复点赞通知
+        # 添加回复点赞通知，短时间内的多次点赞合并为一条
         if reply.user_id != current_user.id:
-            notification = Notification(
-                user_id=reply.user_id,
-                sender_id=current_user.id,
-                notification_type='like_reply',
-                content=f'{current_user.username} 点赞了您的回复',
-                related_id=reply.id
+            notification_queue.emit(
+                notification_event(reply.user_id, current_user, 'like_reply', reply.id)
             )
-            db.session.add(notification)
         
         flash('点赞成功！', 'success')
     
@@ -759,28 +852,17 @@ def reply_post(post_id):
         db.session.add(reply)
         
         # 添加回复通知
+        events = []
         if post.user_id != current_user.id:
-            notification = Notification(
-                user_id=post.user_id,
-                sender_id=current_user.id,
-                notification_type='reply_post',
-                content=f'{current_user.username} 回复了您的帖子',
-                related_id=post.id
-            )
-            db.session.add(notification)
+            events.append(notification_event(post.user_id, current_user, 'reply_post', post.id))
         
         # 如果是回复回复，给被回复的人也发通知
         if quoted_reply_id:
             quoted_reply = Reply.query.get_or_404(quoted_reply_id)
             if quoted_reply.user_id != current_user.id and quoted_reply.user_id != post.user_id:
-                notification = Notification(
-                    user_id=quoted_reply.user_id,
-                    sender_id=current_user.id,
-                    notification_type='reply_reply',
-                    content=f'{current_user.username} 回复了您的评论',
-                    related_id=quoted_reply.id
-                )
-                db.session.add(notification)
+                events.append(notification_event(quoted_reply.user_id, current_user, 'reply_reply', quoted_reply.id))
+        # 多条通知一次批量写入
+        notification_queue.emit(*events)
         
         db.session.commit()
         flash('回复成功！', 'success')
@@ -796,15 +878,13 @@ def delete_post(post_id):
     if post.user_id != current_user.id and not current_user.is_admin:
         abort(403)
     
-    # 删除帖子相关的图片（如果有）
+    # 释放帖子对图片的引用（如果有）
     if post.image_file:
-        from flask import current_app
-        import os
-        image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], post.image_file)
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        release_picture(post.image_file)
     
     # 删除帖子（级联删除会自动处理相关的点赞和回复）
+    remove_document(post)
+    remove_from_timelines(post)
     db.session.delete(post)
     db.session.commit()
     flash('留言已删除', 'success')
@@ -831,7 +911,8 @@ def delete_reply(reply_id):
 @login_required
 def user_info(user_id):
     user = User.query.get_or_404(user_id)
-    return render_template('user_info.html', user=user)
+    is_following = user.id != current_user.id and follow_state(current_user.id, user.id)[0]
+    return render_template('user_info.html', user=user, is_following=is_following)
 
 
 # 其他用户的个人主页路由
@@ -839,30 +920,63 @@ def user_info(user_id):
 @login_required
 def user_profile(user_id):
     user = User.query.get_or_404(user_id)
-    # 增加用户主页访问量
-    user.views += 1
-    db.session.commit()
-    # 获取该用户发布的所有商品
-    user_items = Item.query.filter_by(user_id=user.id).order_by(Item.date_posted.desc()).all()
-    # 获取该用户关注的所有商品
-    followed_items = Item.query.join(Follow).filter(Follow.user_id == user.id).order_by(Follow.date_followed.desc()).all()
-    # 获取该用户发布的所有求购信息
-    user_requests = Request.query.filter_by(user_id=user.id).order_by(Request.date_posted.desc()).all()
-    # 获取该用户发布的所有帖子
-    user_posts = Post.query.filter_by(user_id=user.id).order_by(Post.date_posted.desc()).all()
-    # 获取该用户发布的所有回复
-    user_replies = Reply.query.filter_by(user_id=user.id).order_by(Reply.date_posted.desc()).all()
-    
-    # 只有当查看自己的个人主页时，才获取库存物品
-    user_stocks = []
+    # 增加用户主页访问量（写入内存缓冲区，由后台线程批量落库）
+    view_counter.record_user(user.id)
+    
+    # 只有当查看自己的个人主页时，才需要库存表单
     form = None
+    is_following = is_followed_by = False
     if user.id == current_user.id:
         # 创建库存表单对象
         form = StockForm()
-        # 获取该用户的所有库存物品
-        user_stocks = Stock.query.filter_by(user_id=user.id).order_by(Stock.date_added.desc()).all()
-    
-    return render_template('profile.html', title=f'{user.username}的个人主页', user=user, items=user_items, followed_items=followed_items, requests=user_requests, posts=user_posts, replies=user_replies, stocks=user_stocks, form=form)
+    else:
+        is_following, is_followed_by = follow_state(current_user.id, user.id)
+    
+    return render_template('profile.html', title=f'{user.username}的个人主页', user=user, form=form,
+                           is_following=is_following, is_followed_by=is_followed_by)
+
+
+# 个人主页各标签页：(查询构造函数, 游标排序列, 是否只有本人可见)
+# 每页只加载一屏数据，关注的商品和用户一并加载关联对象，避免渲染时逐条查询
+PROFILE_TABS = {
+    'items': (lambda user_id: Item.query.filter_by(user_id=user_id),
+              [(Item.date_posted, True), (Item.id, True)], False),
+    'followed': (lambda user_id: Follow.query.options(joinedload(Follow.item)).filter_by(user_id=user_id),
+                 [(Follow.date_followed, True), (Follow.id, True)], False),
+    'following': (lambda user_id: UserFollow.query.options(joinedload(UserFollow.followed)).filter_by(follower_id=user_id),
+                  [(UserFollow.date_followed, True), (UserFollow.id, True)], False),
+    'requests': (lambda user_id: Request.query.filter_by(user_id=user_id),
+                 [(Request.date_posted, True), (Request.id, True)], False),
+    'posts': (lambda user_id: Post.query.filter_by(user_id=user_id),
+              [(Post.date_posted, True), (Post.id, True)], False),
+    'replies': (lambda user_id: Reply.query.filter_by(user_id=user_id),
+                [(Reply.date_posted, True), (Reply.id, True)], False),
+    'stocks': (lambda user_id: Stock.query.filter_by(user_id=user_id),
+               [(Stock.date_added, True), (Stock.id, True)], True),
+}
+
+
+@main.route("/user/<int:user_id>/tab/<tab>")
+@login_required
+def profile_tab(user_id, tab):
+    """个人主页标签页片段，首次打开标签页时加载第一页，之后通过after游标加载下一页"""
+    if tab not in PROFILE_TABS:
+        abort(404)
+    build_query, keys, owner_only = PROFILE_TABS[tab]
+    if owner_only and user_id != current_user.id:
+        abort(403)
+    user = User.query.get_or_404(user_id)
+    after = request.args.get('after')
+    pagination = get_keyset_page(build_query(user.id), keys, after=after, per_page=12)
+    next_url = None
+    if pagination.next_args:
+        next_url = url_for('main.profile_tab', user_id=user.id, tab=tab, **pagination.next_args)
+    # 关注列表中每个用户与当前用户的关注关系，一页只查询一次
+    relations = {}
+    if tab == 'following':
+        relations = follow_relations(current_user.id, [follow.followed_id for follow in pagination.items])
+    return render_template('profile_tab.html', user=user, tab=tab, rows=pagination.items,
+                           first_page=not after, next_url=next_url, relations=relations)
 
 
 # 添加库存路由
@@ -926,13 +1040,9 @@ def update_stock(stock_id):
         
         # 处理图片上传（如果有新图片）
         if picture:
-            # 删除旧图片（如果不是默认图片）
+            # 释放旧图片的引用（如果不是默认图片）
             if stock.image_file != 'default.jpg':
-                from flask import current_app
-                import os
-                old_picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], stock.image_file)
-                if os.path.exists(old_picture_path):
-                    os.remove(old_picture_path)
+                release_picture(stock.image_file)
             # 保存新图片
             stock.image_file = save_picture(picture, is_avatar=False)
         
@@ -957,13 +1067,9 @@ def delete_stock(stock_id):
     if stock.user != current_user:
         abort(403)
     
-    # 删除库存物品的图片（如果不是默认图片）
+    # 释放库存物品对图片的引用（如果不是默认图片）
     if stock.image_file != 'default.jpg':
-        from flask import current_app
-        import os
-        picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], stock.image_file)
-        if os.path.exists(picture_path):
-            os.remove(picture_path)
+        release_picture(stock.image_file)
     
     # 从数据库中删除库存物品
     db.session.delete(stock)
@@ -986,86 +1092,123 @@ def messages():
     else:
         users = []
     
-    # 获取当前用户的所有对话对象
-    sent_messages = Message.query.filter_by(sender_id=current_user.id).all()
-    received_messages = Message.query.filter_by(receiver_id=current_user.id).all()
-    
-    # 合并对话对象
-    conversation_users = set()
-    for msg in sent_messages:
-        conversation_users.add(msg.receiver)
-    for msg in received_messages:
-        conversation_users.add(msg.sender)
-    
-    # 按最近消息时间排序
-    def get_latest_message(user):
-        # 获取与该用户的最新消息
-        latest_sent = Message.query.filter_by(sender_id=current_user.id, receiver_id=user.id).order_by(Message.date_sent.desc()).first()
-        latest_received = Message.query.filter_by(sender_id=user.id, receiver_id=current_user.id).order_by(Message.date_sent.desc()).first()
-        
-        if latest_sent and latest_received:
-            return max(latest_sent, latest_received, key=lambda x: x.date_sent)
-        elif latest_sent:
-            return latest_sent
-        elif latest_received:
-            return latest_received
-        return None
-    
-    # 计算未读消息数量
-    def get_unread_count(user):
-        return Message.query.filter_by(sender_id=user.id, receiver_id=current_user.id, is_read=False).count()
+    # 获取当前选中的对话用户
+    selected_user_id = request.args.get('user_id')
+    selected_user = User.query.get(selected_user_id) if selected_user_id else None
     
-    conversation_users = sorted(conversation_users, key=lambda x: get_latest_message(x).date_sent if get_latest_message(x) else datetime.min, reverse=True)
+    # 打开会话时以一条UPDATE将未读消息全部标记为已读，先提交再读取会话列表和聊天记录，
+    # 页面显示的是已读后的状态，提交后也不必逐个刷新已加载的对象
+    if selected_user and mark_thread_read(current_user.id, selected_user.id):
+        db.session.commit()
     
-    # 为每个对话用户添加未读消息数量
+    # 从会话摘要表分页读取对话列表，对话方用户一并加载
+    conv_page = request.args.get('conv_page', 1, type=int)
+    conversations_pagination = get_conversations(current_user.id, conv_page)
     conversation_data = []
-    for user in conversation_users:
+    for conv in conversations_pagination.items:
         conversation_data.append({
-            'user': user,
-            'latest_message': get_latest_message(user),
-            'unread_count': get_unread_count(user)
+            'user': conv.partner,
+            'last_date': conv.last_date,
+            'unread_count': conv.unread_count
         })
     
-    # 获取当前选中的对话用户
-    selected_user_id = request.args.get('user_id')
-    selected_user = User.query.get(selected_user_id) if selected_user_id else None
-    
     # 获取聊天记录
     messages_list = []
     messages_pagination = None
     if selected_user:
-        # 获取页码
-        page = request.args.get('page', 1, type=int)
-        
         # 查询与selected_user的聊天记录
-        messages_query = Message.query.filter(
-            ((Message.sender_id == current_user.id) & (Message.receiver_id == selected_user.id)) |
-            ((Message.sender_id == selected_user.id) & (Message.receiver_id == current_user.id))
-        ).order_by(Message.date_sent.desc())
+        messages_query = Message.query.filter(thread_condition(current_user.id, selected_user.id))
         
-        # 应用分页，每页显示20条消息
-        messages_pagination = messages_query.paginate(page=page, per_page=20, error_out=False)
+        # 按游标分页，默认显示最新的20条消息，通过after游标加载更早的消息
+        messages_pagination = get_keyset_page(messages_query, MESSAGE_KEYS,
+                                              after=request.args.get('after'), before=request.args.get('before'), per_page=20)
         messages_list = messages_pagination.items
         
         # 反转列表，使旧消息在底部
         messages_list = messages_list[::-1]
-        
-        # 将未读消息标记为已读
-        for msg in messages_list:
-            if msg.receiver_id == current_user.id and not msg.is_read:
-                msg.is_read = True
-        db.session.commit()
     
     # 处理发送消息
     if request.method == 'POST' and selected_user:
         content = request.form.get('content')
         if content:
-            message = Message(sender_id=current_user.id, receiver_id=selected_user.id, content=content)
-            db.session.add(message)
+            send_message(current_user.id, selected_user.id, content)
             db.session.commit()
             return redirect(url_for('main.messages', user_id=selected_user.id))
     
-    return render_template('messages.html', title='私信', users=users, conversation_data=conversation_data, selected_user=selected_user, messages=messages_list, messages_pagination=messages_pagination, search_query=search_query)
+    return render_template('messages.html', title='私信', users=users, conversation_data=conversation_data, selected_user=selected_user, messages=messages_list, messages_pagination=messages_pagination, conversations_pagination=conversations_pagination, search_query=search_query)
+
+
+# 聊天记录按(发送时间, id)倒序的游标列
+MESSAGE_KEYS = [(Message.date_sent, True), (Message.id, True)]
+
+
+def _message_payload(message_id, sender_id, content, date_sent):
+    """私信接口返回的单条消息"""
+    return {
+        'id': message_id,
+        'sender_id': sender_id,
+        'content': content,
+        'date_sent': date_sent.isoformat(),
+        'cursor': encode_cursor([date_sent, message_id]),
+    }
+
+
+def _get_partner_id(user_id):
+    """确认对话方存在且不是自己，只查询ID列"""
+    if user_id == current_user.id or db.session.query(User.id).filter_by(id=user_id).first() is None:
+        abort(404)
+    return user_id
+
+
+@main.route('/api/messages/<int:user_id>')
+@login_required
+def message_thread_api(user_id):
+    """
+    增量加载聊天记录
+
+    after游标加载更早的消息，before游标加载更新的消息，不带游标时返回最新的一页。
+    消息按时间正序返回；older为继续加载更早消息的游标，newer为最新一条消息的游标，
+    可用于轮询新消息。
+    """
+    partner_id = _get_partner_id(user_id)
+    before = request.args.get('before')
+    # 只查询需要的列，不构造ORM对象
+    query = (db.session.query(Message.id, Message.sender_id, Message.content, Message.date_sent)
+             .filter(thread_condition(current_user.id, partner_id)))
+    pagination = get_keyset_page(query, MESSAGE_KEYS, after=request.args.get('after'), before=before,
+                                 per_page=max(1, min(request.args.get('limit', 20, type=int), 100)))
+    rows = pagination.items[::-1]
+    return jsonify({
+        'items': [_message_payload(*row) for row in rows],
+        'older': pagination.next_args['after'] if pagination.has_next else None,
+        'newer': encode_cursor([rows[-1].date_sent, rows[-1].id]) if rows else before,
+    })
+
+
+@main.route('/api/messages/<int:user_id>', methods=['POST'])
+@login_required
+def send_message_api(user_id):
+    """发送一条私信，只写入消息和会话摘要，返回新消息"""
+    partner_id = _get_partner_id(user_id)
+    data = request.get_json(silent=True) or request.form
+    content = (data.get('content') or '').strip()
+    if not content:
+        return jsonify({'success': False, 'message': '消息内容不能为空'}), 400
+    message = send_message(current_user.id, partner_id, content)
+    # 提交后对象属性会过期，先取出返回值避免再次查询
+    payload = _message_payload(message.id, message.sender_id, message.content, message.date_sent)
+    db.session.commit()
+    return jsonify(payload), 201
+
+
+@main.route('/api/messages/<int:user_id>/read', methods=['POST'])
+@login_required
+def read_thread_api(user_id):
+    """将与对话方的聊天标记为已读"""
+    partner_id = _get_partner_id(user_id)
+    count = mark_thread_read(current_user.id, partner_id)
+    db.session.commit()
+    return jsonify({'success': True, 'read': count})
 
 
 # 搜索用户路由
@@ -1081,6 +1224,9 @@ def search_users():
     else:
         users = User.query.filter(User.id != current_user.id).all()
     
+    # 批量查询当前用户关注了其中哪些用户
+    followed = following_ids(current_user.id, [user.id for user in users])
+    
     # 返回JSON格式的用户列表
     users_data = []
     for user in users:
@@ -1089,7 +1235,8 @@ def search_users():
             'username': user.username,
             'email': user.email,
             'avatar': user.avatar,
-            'avatar_url': url_for('static', filename=f'uploads/avatars/{user.avatar}', _external=True)
+            'avatar_url': upload_url(user.avatar, is_avatar=True),
+            'is_following': user.id in followed
         })
     
     return jsonify(users_data)
@@ -1099,16 +1246,39 @@ def search_users():
 @main.route('/notifications')
 @login_required
 def notifications():
-    # 获取页码
-    page = request.args.get('page', 1, type=int)
-    
-    # 获取当前用户的所有通知，按时间倒序排列
-    query = Notification.query.filter_by(user_id=current_user.id).order_by(Notification.date_created.desc())
-    
-    # 应用分页
-    pagination, notifications_list = get_pagination_data(query, page, per_page=20)
+    # 获取当前用户的通知，按时间倒序游标分页
+    pagination = _notifications_page(current_user.id)
     
-    return render_template('notifications.html', title='通知', notifications=notifications_list, pagination=pagination)
+    return render_template('notifications.html', title='通知', notifications=pagination.items, pagination=pagination)
+
+
+# 通知按(创建时间, id)倒序的游标列
+NOTIFICATION_KEYS = [(Notification.date_created, True), (Notification.id, True)]
+
+
+def _notifications_page(user_id, per_page=20):
+    """获取用户的一页通知，通知页面和无限滚动接口共用"""
+    query = Notification.query.filter_by(user_id=user_id)
+    return get_keyset_page(query, NOTIFICATION_KEYS, after=request.args.get('after'),
+                           before=request.args.get('before'), per_page=per_page)
+
+
+@main.route('/api/notifications')
+@login_required
+def notifications_api():
+    """通知列表无限滚动接口，通过after游标加载更早的通知"""
+    pagination = _notifications_page(current_user.id)
+    return jsonify({
+        'items': [{
+            'id': notification.id,
+            'type': notification.notification_type,
+            'content': notification.content,
+            'related_id': notification.related_id,
+            'is_read': notification.is_read,
+            'date_created': notification.date_created.strftime('%Y-%m-%d %H:%M'),
+        } for notification in pagination.items],
+        'next': url_for('main.notifications_api', **pagination.next_args) if pagination.has_next else None,
+    })
 
 
 # 标记所有通知为已读路由
@@ -1117,7 +1287,7 @@ def notifications():
 def mark_all_notifications_read():
     try:
         # 将当前用户的所有未读通知标记为已读
-        Notification.query.filter_by(user_id=current_user.id, is_read=False).update({'is_read': True})
+        clear_unread_notifications(current_user.id)
         db.session.commit()
         flash('所有通知已标记为已读', 'success')
         return redirect(url_for('main.notifications'))
@@ -1136,9 +1306,8 @@ def notification_redirect(notification_id):
     if notification.user_id != current_user.id:
         abort(403)
     
-    # 标记通知为已读
-    if not notification.is_read:
-        notification.is_read = True
+    # 标记通知为已读（同一对象的同类未读通知一并标记）
+    if not notification.is_read and mark_notification_read(notification):
         db.session.commit()
     
     # 根据通知类型跳转到相应页面
@@ -1155,6 +1324,12 @@ def notification_redirect(notification_id):
         # 跳转到被回复或点赞的回复所在的帖子页面
         reply = Reply.query.get_or_404(notification.related_id)
         return redirect(url_for('main.square') + f'#post-{reply.post_id}')
+    elif notification.notification_type == 'match_request':
+        # 跳转到符合求购的新商品页面
+        return redirect(url_for('main.item_detail', item_id=notification.related_id))
+    elif notification.notification_type == 'match_item':
+        # 跳转到与商品相符的新求购页面
+        return redirect(url_for('main.request_detail', request_id=notification.related_id))
     elif notification.notification_type == 'buy_item':
         # 跳转到购买通知详情页面
         return redirect(url_for('main.notification_order', notification_id=notification.id))
@@ -1180,8 +1355,7 @@ def forward_to_message(item_id):
     message_content = f"【商品转发】\n商品名称：{item.title}\n商品价格：¥{item.price}\n商品链接：{request.host_url}item/{item.id}\n卖家：{item.seller.username}\n库存：{item.stock}\n浏览：{item.views}\n关注：{len(item.followers)}\n\n{item.description}"
     
     # 创建消息
-    message = Message(sender_id=current_user.id, receiver_id=receiver.id, content=message_content)
-    db.session.add(message)
+    send_message(current_user.id, receiver.id, message_content)
     db.session.commit()
     
     return jsonify({'success': True, 'message': '转发成功'})
@@ -1204,8 +1378,7 @@ def forward_request_to_message(request_id):
     message_content = f"【求购转发】\n求购名称：{req.title}\n期望价格：¥{req.price}\n求购链接：{request.host_url}request/{req.id}\n求购者：{req.user.username}\n发布时间：{req.date_posted.strftime('%Y-%m-%d')}\n\n{req.description}"
     
     # 创建消息
-    message = Message(sender_id=current_user.id, receiver_id=receiver.id, content=message_content)
-    db.session.add(message)
+    send_message(current_user.id, receiver.id, message_content)
     db.session.commit()
     
     return jsonify({'success': True, 'message': '转发成功'})
@@ -1267,6 +1440,7 @@ def delete_comment(comment_id):
         print(f"User {current_user.username} (ID: {current_user.id}) deleted comment {comment.id} at {datetime.utcnow()}")
         
         # 删除评论
+        release_picture(comment.image_file)
         db.session.delete(comment)
         db.session.commit()
         
@@ -1307,62 +1481,24 @@ def buy_item(item_id):
 def payment_success(item_id, quantity):
     item = Item.query.get_or_404(item_id)
     
-    # 计算总价
-    total_price = item.price * quantity
-    
-    # 使用数据库事务确保数据一致性
+    # 扣减库存、写入买家库存、更新计数器和发送通知在同一事务中完成，
+    # 库存以条件UPDATE原子扣减，并发购买不会超卖
     try:
-        # 1. 更新商品库存
-        item.stock -= quantity
-        if item.stock < 0:
-            flash('商品库存不足！', 'danger')
-            return redirect(url_for('main.item_detail', item_id=item_id))
-        
-        # 2. 添加商品到买家库存
-        # 检查买家库存中是否已有该商品
-        existing_stock = Stock.query.filter_by(user_id=current_user.id, name=item.title).first()
-        if existing_stock:
-            # 如果已有该商品，增加数量
-            existing_stock.quantity += quantity
-        else:
-            # 如果没有该商品，创建新的库存记录
-            new_stock = Stock(
-                name=item.title,
-                quantity=quantity,
-                description=item.description,
-                image_file=item.image_file,
-                user_id=current_user.id
-            )
-            db.session.add(new_stock)
-        
-        # 3. 更新卖家成交量
-        item.seller.sales_count += 1
-        
-        # 4. 更新商品已售数量
-        item.sales_count += quantity
-        
-        # 5. 发送购买通知给卖家
-        notification = Notification(
-            user_id=item.seller.id,
-            sender_id=current_user.id,
-            notification_type='buy_item',
-            content=f'{current_user.username} 购买了你的商品 "{item.title}"！',
-            related_id=item.id
-        )
-        db.session.add(notification)
-        
-        # 提交事务
-        db.session.commit()
-        flash('购买成功！', 'success')
+        order = purchase_item(current_user, item.id, quantity)
+    except PurchaseError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('main.item_detail', item_id=item_id))
     except Exception as e:
         # 发生异常，回滚事务
         db.session.rollback()
         flash('购买失败，请稍后重试！', 'danger')
         print(f"购买失败错误: {e}")
         return redirect(url_for('main.item_detail', item_id=item_id))
+    fragment_cache.bump('market')
+    flash('购买成功！', 'success')
     
     # 渲染支付成功页面
-    return render_template('payment_success.html', item=item, quantity=quantity, total_price=total_price)
+    return render_template('payment_success.html', item=order.item, quantity=order.quantity, total_price=order.total_price)
 
 # 通知订单详情路由
 @main.route("/notification/order/<int:notification_id>")
@@ -1375,33 +1511,69 @@ def notification_order(notification_id):
     if notification.user_id != current_user.id:
         abort(403)
     
-    # 获取关联的商品
-    item = Item.query.get_or_404(notification.related_id)
-    
-    # 获取购买者信息
-    buyer = User.query.get_or_404(notification.sender_id)
-    
-    # 计算订单金额（假设购买数量为1，实际项目中应该从订单表获取）
-    quantity = 1  # 实际项目中应该从订单表获取
-    total_price = item.price * quantity
+    # 购买通知关联订单，数量和成交价以订单记录为准
+    order = get_notification_order(notification)
+    if order is None:
+        # 订单表上线前的旧通知（related_id为商品ID），执行backfill-orders前按商品信息显示，
+        # 不显示ID恰好相同的其他订单
+        item = db.session.get(Item, notification.related_id)
+        return render_template('notification_order.html', notification=notification, order=None,
+                               item=item, buyer=notification.sender)
     
     # 渲染订单详情页面
-    return render_template('notification_order.html', notification=notification, item=item, buyer=buyer, quantity=quantity, total_price=total_price)
+    return render_template('notification_order.html', notification=notification, order=order)
 
 
 # 榜单路由
 @main.route("/rankings")
 @login_required
 def rankings():
+    # 排行榜读取定期重算的快照，快照最多延迟LEADERBOARD_MAX_AGE秒
+    from flask import current_app
+    limit = current_app.config['LEADERBOARD_SIZE']
+    max_age = current_app.config['LEADERBOARD_MAX_AGE']
     # 商品排行榜 - 按热度排序：浏览量*1+关注量*3+已售数量*5
-    items = Item.query.all()
-    items.sort(key=lambda x: x.views + len(x.followers) * 3 + x.sales_count * 5, reverse=True)
-    
+    items, refreshed_at, stale = get_leaderboard('item', limit, max_age)
     # 用户排行榜 - 按热度排序：人气*3+成交量*2+主页浏览量*1
-    users = User.query.all()
-    users.sort(key=lambda x: x.followers.count() * 3 + x.sales_count * 2 + x.views, reverse=True)
+    users, user_refreshed_at, user_stale = get_leaderboard('user', limit, max_age)
+    # 两个榜单同时刷新，商品榜为空时使用用户榜的刷新时间
+    refreshed_at = refreshed_at or user_refreshed_at
+    stale = stale and user_stale
     
-    return render_template('rankings.html', title='排行榜', items=items[:10], users=users[:10])
+    return render_template('rankings.html', title='排行榜', items=items, users=users, refreshed_at=refreshed_at,
+                           stale=stale, max_age=max_age)
+
+
+# 上传图片，带长期缓存头并支持条件请求和Range请求
+@main.route("/uploads/<path:filename>")
+def uploaded_file(filename):
+    return send_upload(filename)
+
+
+# 上传图片处理状态，页面可据此轮询后台处理结果
+@main.route("/upload/status/<path:filename>")
+@login_required
+def upload_status(filename):
+    if '..' in filename.split('/'):
+        abort(404)
+    return jsonify({'status': image_pipeline.status(filename), 'url': upload_url(filename)})
+
+
+# 私信和通知推送路由（Server-Sent Events）
+@main.route("/events/stream")
+@login_required
+def event_stream():
+    # 生成器不使用请求上下文，视图返回后数据库会话即释放，推送期间不占用数据库连接
+    stream = event_hub.stream(
+        current_user.id,
+        heartbeat=current_app.config['EVENT_STREAM_HEARTBEAT'],
+        max_duration=current_app.config['EVENT_STREAM_MAX_DURATION']
+    )
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 关闭Nginx的响应缓冲，事件立即送达浏览器
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 # 上下文处理器 - 修复版本
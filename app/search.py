@@ -0,0 +1,264 @@
+import math
+import re
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import case, func, literal, text
+
+from .models import db, Item, Request, Post, SearchToken
+from .utils import cached_count
+
+# 可搜索的文档类型：(模型, 标题列, 正文列)
+SEARCH_FIELDS = {
+    'item': (Item, Item.title, Item.description),
+    'request': (Request, Request.title, Request.description),
+    'post': (Post, None, Post.content),
+}
+
+# 标题中出现的词权重
+TITLE_WEIGHT = 3
+# 词的最大长度，与SearchToken.token列长度一致
+MAX_TOKEN_LENGTH = 40
+
+_WORD_RE = re.compile(r'[0-9a-z]+|[㐀-䶿一-鿿豈-﫿]+')
+_CJK_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿]')
+
+
+def tokenize(text_value):
+    """
+    将文本切分为搜索词
+
+    英文和数字按连续字母数字切分并转为小写；中文按相邻两字切分为二元词，
+    单个汉字单独成词。
+
+    Args:
+        text_value: 原始文本
+
+    Returns:
+        list: 搜索词列表（可能重复）
+    """
+    tokens = []
+    for word in _WORD_RE.findall((text_value or '').lower()):
+        if _CJK_RE.match(word):
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word[:MAX_TOKEN_LENGTH])
+    return tokens
+
+
+class LikeSearchBackend:
+    """LIKE模糊匹配，不使用索引也不做相关度排序"""
+
+    def apply(self, query, kind, search_query, rank=False):
+        model, title, body = SEARCH_FIELDS[kind]
+        search_pattern = f'%{search_query}%'
+        condition = body.like(search_pattern)
+        if title is not None:
+            condition = title.like(search_pattern) | condition
+        return query.filter(condition)
+
+    def index(self, kind, doc_id, title, body, replace=True):
+        pass
+
+    def remove(self, kind, doc_id):
+        pass
+
+
+class InvertedIndexBackend:
+    """
+    基于SearchToken表的倒排索引
+
+    写入时分词并随业务事务一起保存，查询时按词走索引定位文档，
+    按TF-IDF计算相关度，查询耗时与匹配文档数相关而与总数据量无关。
+    搜索词的最后一个词按前缀匹配（输入"iph"可以搜到"iPhone"，"iphone"可以搜到
+    "iPhone13Pro"），其余的词需完整匹配；与LIKE不同，不匹配词中间的片段（如"13pro"）。
+    """
+
+    fallback = LikeSearchBackend()
+
+    def apply(self, query, kind, search_query, rank=False):
+        model, _, _ = SEARCH_FIELDS[kind]
+        words = tokenize(search_query)
+        # 单个汉字不在索引中（文档只索引二元词），退回LIKE匹配
+        if not words or any(len(t) == 1 and _CJK_RE.match(t) for t in words):
+            return self.fallback.apply(query, kind, search_query, rank)
+
+        # 词只含字母、数字和汉字，无需转义LIKE通配符；前缀匹配仍可使用(kind, token)索引
+        prefix = words[-1]
+        tokens = sorted(set(words) - {prefix})
+        is_exact = SearchToken.token.in_(tokens)
+        is_prefix = SearchToken.token.like(f'{prefix}%')
+        condition = (SearchToken.kind == kind) & (is_exact | is_prefix)
+
+        # 先取各词的文档频率计算IDF，再在一条分组查询中累加相关度
+        doc_freq = dict(db.session.query(SearchToken.token, func.count(SearchToken.id))
+                        .filter(SearchToken.kind == kind, is_exact)
+                        .group_by(SearchToken.token).all()) if tokens else {}
+        prefix_freq = (db.session.query(func.count(func.distinct(SearchToken.doc_id)))
+                       .filter(SearchToken.kind == kind, is_prefix).scalar())
+        # 文档总数只影响IDF的相对大小，使用缓存的近似值，避免每次搜索都统计全表
+        total = cached_count(('search_total', kind), model.query) or 1
+        idf = case(
+            {token: math.log(1 + total / (1 + doc_freq.get(token, 0))) for token in tokens},
+            value=SearchToken.token,
+            else_=math.log(1 + total / (1 + prefix_freq))
+        ) if tokens else literal(math.log(1 + total / (1 + prefix_freq)))
+        matched_tokens = func.count(func.distinct(case((is_exact, SearchToken.token))))
+        matched_prefix = func.max(case((is_prefix, 1), else_=0))
+        matches = (db.session.query(SearchToken.doc_id.label('doc_id'),
+                                    func.sum(SearchToken.weight * idf).label('score'))
+                   .filter(condition)
+                   .group_by(SearchToken.doc_id)
+                   .having((matched_tokens == len(tokens)) & (matched_prefix == 1))
+                   .subquery())
+        query = query.join(matches, model.id == matches.c.doc_id)
+        if rank:
+            query = query.order_by(matches.c.score.desc())
+        return query
+
+    def index(self, kind, doc_id, title, body, replace=True):
+        if replace:
+            self.remove(kind, doc_id)
+        weights = Counter()
+        for token in tokenize(title):
+            weights[token] += TITLE_WEIGHT
+        for token in tokenize(body):
+            weights[token] += 1
+        db.session.bulk_insert_mappings(SearchToken, [
+            {'kind': kind, 'token': token, 'doc_id': doc_id, 'weight': weight}
+            for token, weight in weights.items()
+        ])
+
+    def remove(self, kind, doc_id):
+        SearchToken.query.filter_by(kind=kind, doc_id=doc_id).delete(synchronize_session=False)
+
+
+class FullTextSearchBackend:
+    """
+    SQL Server全文索引（CONTAINSTABLE）
+
+    需要DBA预先为item(title, description)、request(title, description)和
+    post(content)建立全文目录和全文索引，全文索引由SQL Server自动维护。
+    """
+
+    fallback = LikeSearchBackend()
+
+    def apply(self, query, kind, search_query, rank=False):
+        model, title, body = SEARCH_FIELDS[kind]
+        words = [w.replace('"', '') for w in search_query.split() if w.replace('"', '')]
+        if not words:
+            return self.fallback.apply(query, kind, search_query, rank)
+        columns = ', '.join(c.name for c in (title, body) if c is not None)
+        condition = ' AND '.join(f'"{w}*"' for w in words)
+        matches = (text(f'SELECT [KEY] AS doc_id, [RANK] AS score '
+                        f'FROM CONTAINSTABLE({model.__tablename__}, ({columns}), :condition)')
+                   .bindparams(condition=condition)
+                   .columns(doc_id=db.Integer, score=db.Integer)
+                   .subquery())
+        query = query.join(matches, model.id == matches.c.doc_id)
+        if rank:
+            query = query.order_by(matches.c.score.desc())
+        return query
+
+    def index(self, kind, doc_id, title, body, replace=True):
+        pass
+
+    def remove(self, kind, doc_id):
+        pass
+
+
+BACKENDS = {
+    'like': LikeSearchBackend,
+    'index': InvertedIndexBackend,
+    'fulltext': FullTextSearchBackend,
+}
+
+
+def get_backend():
+    """返回配置项SEARCH_BACKEND指定的搜索后端"""
+    return BACKENDS[current_app.config.get('SEARCH_BACKEND', 'index')]()
+
+
+def apply_search(query, kind, search_query, rank=False):
+    """
+    为查询加上搜索条件
+
+    Args:
+        query: SQLAlchemy查询对象
+        kind: 文档类型，item、request或post
+        search_query: 用户输入的搜索内容
+        rank: 是否按相关度排序
+
+    Returns:
+        Query: 加上搜索条件的查询对象
+    """
+    return get_backend().apply(query, kind, search_query, rank)
+
+
+def index_document(obj):
+    """
+    更新商品、求购或帖子在搜索索引中的内容
+
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        obj: Item、Request或Post对象
+    """
+    for kind, (model, title, body) in SEARCH_FIELDS.items():
+        if isinstance(obj, model):
+            if obj.id is None:
+                db.session.flush()
+            title_value = getattr(obj, title.key) if title is not None else ''
+            get_backend().index(kind, obj.id, title_value, getattr(obj, body.key))
+            return
+
+
+def remove_document(obj):
+    """
+    从搜索索引中删除商品、求购或帖子
+
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        obj: Item、Request或Post对象
+    """
+    for kind, (model, _, _) in SEARCH_FIELDS.items():
+        if isinstance(obj, model):
+            get_backend().remove(kind, obj.id)
+            return
+
+
+def rebuild_search_index(batch_size=1000):
+    """
+    清空并重建全部搜索索引
+
+    Args:
+        batch_size: 每批读取的文档数
+
+    Returns:
+        int: 建立索引的文档数量
+    """
+    backend = get_backend()
+    SearchToken.query.delete(synchronize_session=False)
+    count = 0
+    for kind, (model, title, body) in SEARCH_FIELDS.items():
+        columns = [model.id, title if title is not None else db.literal(''), body]
+        last_id = 0
+        while True:
+            rows = (db.session.query(*columns)
+                    .filter(model.id > last_id)
+                    .order_by(model.id.asc())
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                break
+            for doc_id, title_value, body_value in rows:
+                backend.index(kind, doc_id, title_value, body_value, replace=False)
+            last_id = rows[-1][0]
+            count += len(rows)
+            db.session.commit()
+    db.session.commit()
+    return count
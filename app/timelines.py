@@ -0,0 +1,242 @@
+from flask import current_app
+from sqlalchemy import exists, func, insert, literal, select, union_all
+from sqlalchemy.orm import joinedload
+
+from .models import db, User, Item, Request, Post, UserFollow, TimelineEntry
+
+# 写入时间线的内容类型：(模型, 发布时间列, 发布者关系名)
+TIMELINE_SOURCES = {
+    'item': (Item, Item.date_posted, 'seller'),
+    'request': (Request, Request.date_posted, 'user'),
+    'post': (Post, Post.date_posted, 'user'),
+}
+
+
+def _kind_of(obj):
+    for kind, (model, _, _) in TIMELINE_SOURCES.items():
+        if isinstance(obj, model):
+            return kind
+    raise ValueError(f'不支持写入时间线的对象: {obj!r}')
+
+
+def _is_celebrity(user_id):
+    """粉丝数超过TIMELINE_FANOUT_LIMIT的用户不在发布时写入粉丝时间线"""
+    user = db.session.get(User, user_id)
+    return user.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT']
+
+
+def fan_out(obj):
+    """
+    把新发布的商品、求购或帖子写入发布者所有粉丝的时间线
+
+    以单条INSERT ... SELECT按粉丝列表写入；粉丝过多的用户跳过写入，
+    由粉丝读取时间线时直接合并其内容。
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        obj: Item、Request或Post对象
+
+    Returns:
+        int: 写入的时间线条数
+    """
+    kind = _kind_of(obj)
+    if obj.id is None:
+        db.session.flush()
+    if _is_celebrity(obj.user_id):
+        return 0
+    date_column = TIMELINE_SOURCES[kind][1]
+    statement = insert(TimelineEntry).from_select(
+        ['user_id', 'author_id', 'kind', 'ref_id', 'date_created'],
+        select(UserFollow.follower_id, literal(obj.user_id), literal(kind), literal(obj.id),
+               literal(getattr(obj, date_column.key)))
+        .where(UserFollow.followed_id == obj.user_id)
+    )
+    return db.session.execute(statement).rowcount
+
+
+def remove_from_timelines(obj):
+    """
+    从所有时间线中移除被删除的内容
+
+    不提交事务，由调用方提交。
+
+    Args:
+        obj: Item、Request或Post对象
+    """
+    TimelineEntry.query.filter_by(kind=_kind_of(obj), ref_id=obj.id).delete(synchronize_session=False)
+
+
+def backfill_timeline(user_id, author_id):
+    """
+    关注用户后，把对方最近发布的内容补入自己的时间线
+
+    每种内容最多补入TIMELINE_BACKFILL_SIZE条，已在时间线中的内容跳过。
+    不提交事务，由调用方提交。
+
+    Args:
+        user_id: 关注者ID
+        author_id: 被关注者ID
+    """
+    if _is_celebrity(author_id):
+        return
+    limit = current_app.config['TIMELINE_BACKFILL_SIZE']
+    for kind, (model, date_column, _) in TIMELINE_SOURCES.items():
+        recent = (select(literal(user_id), model.user_id, literal(kind), model.id, date_column)
+                  .where(model.user_id == author_id,
+                         ~exists().where(TimelineEntry.user_id == user_id,
+                                         TimelineEntry.kind == kind,
+                                         TimelineEntry.ref_id == model.id))
+                  .order_by(date_column.desc())
+                  .limit(limit))
+        db.session.execute(insert(TimelineEntry).from_select(
+            ['user_id', 'author_id', 'kind', 'ref_id', 'date_created'], recent
+        ))
+
+
+def backfill_followers(author_id):
+    """
+    取消关注使用户的粉丝数降回TIMELINE_FANOUT_LIMIT时，把其最近发布的内容补入所有粉丝的时间线
+
+    粉丝数超过上限期间发布的内容没有写入时间线，期间新增的粉丝也没有补入，
+    降回上限后读取时不再合并其内容，需在此时补入。粉丝数不等于上限时不做任何修改。
+    每种内容最多补入TIMELINE_BACKFILL_SIZE条，已在时间线中的内容跳过。
+    不提交事务，由调用方提交。
+
+    Args:
+        author_id: 被取消关注的用户ID
+    """
+    if db.session.get(User, author_id).follower_count != current_app.config['TIMELINE_FANOUT_LIMIT']:
+        return
+    limit = current_app.config['TIMELINE_BACKFILL_SIZE']
+    for kind, (model, date_column, _) in TIMELINE_SOURCES.items():
+        recent = (select(model.id)
+                  .where(model.user_id == author_id)
+                  .order_by(date_column.desc())
+                  .limit(limit))
+        rows = (select(UserFollow.follower_id, model.user_id, literal(kind), model.id, date_column)
+                .join(model, model.user_id == UserFollow.followed_id)
+                .where(UserFollow.followed_id == author_id,
+                       model.id.in_(recent),
+                       ~exists().where(TimelineEntry.user_id == UserFollow.follower_id,
+                                       TimelineEntry.kind == kind,
+                                       TimelineEntry.ref_id == model.id)))
+        db.session.execute(insert(TimelineEntry).from_select(
+            ['user_id', 'author_id', 'kind', 'ref_id', 'date_created'], rows
+        ))
+
+
+def remove_author(user_id, author_id):
+    """
+    取消关注后，从自己的时间线中移除对方的内容
+
+    不提交事务，由调用方提交。
+
+    Args:
+        user_id: 关注者ID
+        author_id: 被取消关注的用户ID
+    """
+    TimelineEntry.query.filter_by(user_id=user_id, author_id=author_id).delete(synchronize_session=False)
+
+
+def timeline_query(user_id):
+    """
+    构造用户关注动态的查询，供get_keyset_page分页
+
+    普通情况下只读取时间线表中该用户的一段索引范围；关注了粉丝过多的用户时，
+    再用UNION ALL合并这些用户直接发布的内容，其在时间线表中的旧记录不参与合并，
+    避免重复。
+
+    Args:
+        user_id: 用户ID
+
+    Returns:
+        tuple: (查询对象, 游标排序列)，每行包含kind、ref_id、author_id和date_created
+    """
+    limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    celebrity_ids = [followed_id for (followed_id,) in
+                     db.session.query(UserFollow.followed_id)
+                     .join(User, User.id == UserFollow.followed_id)
+                     .filter(UserFollow.follower_id == user_id, User.follower_count > limit)]
+    entries = (select(TimelineEntry.kind, TimelineEntry.ref_id, TimelineEntry.author_id, TimelineEntry.date_created)
+               .where(TimelineEntry.user_id == user_id))
+    if celebrity_ids:
+        entries = entries.where(TimelineEntry.author_id.notin_(celebrity_ids))
+        source = union_all(entries, *[
+            select(literal(kind), model.id, model.user_id, date_column)
+            .where(model.user_id.in_(celebrity_ids))
+            for kind, (model, date_column, _) in TIMELINE_SOURCES.items()
+        ]).subquery()
+    else:
+        source = entries.subquery()
+    keys = [(source.c.date_created, True), (source.c.kind, True), (source.c.ref_id, True)]
+    return db.session.query(source), keys
+
+
+def load_timeline_items(rows):
+    """
+    按种类批量加载一页时间线对应的内容及其发布者
+
+    Args:
+        rows: timeline_query的结果行
+
+    Returns:
+        list: [(kind, 对象)]，保持时间线顺序，已删除的内容被跳过
+    """
+    ids = {}
+    for row in rows:
+        ids.setdefault(row.kind, []).append(row.ref_id)
+    loaded = {}
+    for kind, ref_ids in ids.items():
+        model, _, author = TIMELINE_SOURCES[kind]
+        for obj in model.query.options(joinedload(getattr(model, author))).filter(model.id.in_(ref_ids)):
+            loaded[kind, obj.id] = obj
+    return [(row.kind, loaded[row.kind, row.ref_id]) for row in rows if (row.kind, row.ref_id) in loaded]
+
+
+def trim_timelines(max_length):
+    """
+    删除每个用户时间线中超出保留条数的旧记录
+
+    Args:
+        max_length: 每个用户保留的最大条数
+
+    Returns:
+        int: 删除的记录数
+    """
+    ranked = select(
+        TimelineEntry.id,
+        func.row_number().over(
+            partition_by=TimelineEntry.user_id,
+            order_by=(TimelineEntry.date_created.desc(), TimelineEntry.id.desc())
+        ).label('position')
+    ).subquery()
+    stale = select(ranked.c.id).where(ranked.c.position > max_length)
+    deleted = TimelineEntry.query.filter(TimelineEntry.id.in_(stale)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def rebuild_timelines():
+    """
+    根据关注关系和已发布的内容重建所有时间线
+
+    用于新增时间线表后的数据回填；粉丝过多的用户不写入，读取时合并。
+
+    Returns:
+        int: 写入的时间线条数（裁剪前）
+    """
+    TimelineEntry.query.delete(synchronize_session=False)
+    limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    count = 0
+    for kind, (model, date_column, _) in TIMELINE_SOURCES.items():
+        rows = (select(UserFollow.follower_id, model.user_id, literal(kind), model.id, date_column)
+                .join(model, model.user_id == UserFollow.followed_id)
+                .join(User, User.id == UserFollow.followed_id)
+                .where(User.follower_count <= limit))
+        result = db.session.execute(insert(TimelineEntry).from_select(
+            ['user_id', 'author_id', 'kind', 'ref_id', 'date_created'], rows
+        ))
+        count += result.rowcount
+    db.session.commit()
+    trim_timelines(current_app.config['TIMELINE_MAX_LENGTH'])
+    return count
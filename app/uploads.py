@@ -0,0 +1,161 @@
+import re
+from datetime import datetime, timedelta
+
+from flask import abort, current_app, send_from_directory
+from sqlalchemy import func, insert, literal, select, union_all
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, User, Item, Request, Post, Stock, Comment, UploadBlob
+from .image_pipeline import image_pipeline
+
+# 由上传生成的文件名（内容哈希或旧版随机十六进制名），站点自带的图片不参与回收
+BLOB_NAME_RE = re.compile(r'^[0-9a-f]{16}\.(jpg|jpeg|png)$')
+# 上传图片及其尺寸版本的文件名，同名文件内容不会改变，可长期缓存
+IMMUTABLE_NAME_RE = re.compile(r'^[0-9a-f]{16}(_thumb|_full)?\.(jpg|jpeg|png|webp)$')
+
+
+def _blob_path(filename, is_avatar):
+    return f'avatars/{filename}' if is_avatar else filename
+
+
+def retain_picture(filename, is_avatar=False):
+    """
+    增加上传图片的引用数，新保存的图片或把图片复制给其他记录时调用
+
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        filename: 图片文件名
+        is_avatar: 是否为头像图片
+    """
+    if not filename or not BLOB_NAME_RE.match(filename):
+        return
+    path = _blob_path(filename, is_avatar)
+    if _increment_ref_count(path):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(UploadBlob).values(path=path, ref_count=1))
+    except IntegrityError:
+        # 并发请求已登记同一图片（相同内容的图片同时上传），改为增加引用数
+        _increment_ref_count(path)
+
+
+def _increment_ref_count(path):
+    return UploadBlob.query.filter_by(path=path).update(
+        {UploadBlob.ref_count: UploadBlob.ref_count + 1}, synchronize_session=False
+    )
+
+
+def release_picture(filename, is_avatar=False):
+    """
+    减少上传图片的引用数
+
+    不再直接删除文件，引用数降为0的图片由gc-uploads命令在保留期后批量删除。
+    不提交事务，由调用方与业务写操作一并提交。
+
+    Args:
+        filename: 图片文件名
+        is_avatar: 是否为头像图片
+    """
+    if not filename or not BLOB_NAME_RE.match(filename):
+        return
+    UploadBlob.query.filter_by(path=_blob_path(filename, is_avatar)).update({
+        UploadBlob.ref_count: UploadBlob.ref_count - 1,
+        UploadBlob.date_released: datetime.utcnow(),
+    }, synchronize_session=False)
+
+
+def reconcile_upload_refs():
+    """
+    根据各表中的图片列重新计算所有图片的引用数
+
+    上传目录中没有任何记录引用的旧图片也会登记为0引用，随后由垃圾回收删除。
+
+    Returns:
+        int: 登记的图片数量
+    """
+    refs = union_all(
+        select(Item.image_file.label('path')),
+        select(Request.image_file),
+        select(Post.image_file).where(Post.image_file.isnot(None)),
+        select(Comment.image_file).where(Comment.image_file.isnot(None)),
+        select(Stock.image_file),
+        select(literal('avatars/') + User.avatar),
+    ).subquery()
+    counts = dict(db.session.query(refs.c.path, func.count()).group_by(refs.c.path).all())
+    for path in image_pipeline.main_images():
+        counts.setdefault(path, 0)
+
+    now = datetime.utcnow()
+    blobs = [
+        {'path': path, 'ref_count': count, 'date_released': None if count else now}
+        for path, count in counts.items()
+        if BLOB_NAME_RE.match(path.rsplit('/', 1)[-1])
+    ]
+    UploadBlob.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(UploadBlob, blobs)
+    db.session.commit()
+    return len(blobs)
+
+
+def collect_unreferenced_uploads(grace, batch_size=500):
+    """
+    删除引用数为0且超过保留期的图片及其所有尺寸版本
+
+    Args:
+        grace: 引用数降为0后保留的秒数，避免误删刚上传尚未保存到记录中的图片
+        batch_size: 每次最多处理的图片数量
+
+    Returns:
+        int: 删除的图片数量
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    paths = [path for (path,) in db.session.query(UploadBlob.path)
+             .filter(UploadBlob.ref_count <= 0, UploadBlob.date_released < cutoff)
+             .order_by(UploadBlob.id)
+             .limit(batch_size)]
+    count = 0
+    for path in paths:
+        # 删除记录时再次确认引用数，期间重新被引用的图片保留
+        deleted = UploadBlob.query.filter(
+            UploadBlob.path == path, UploadBlob.ref_count <= 0
+        ).delete(synchronize_session=False)
+        if deleted:
+            # 在持有该记录删除锁的事务中删除文件：并发上传相同图片时retain_picture
+            # 会等待本事务提交，随后store()发现文件已不存在并重新暂存
+            image_pipeline.delete(path)
+            count += 1
+        db.session.commit()
+    return count
+
+
+def send_upload(relative_path):
+    """
+    发送上传目录中的图片
+
+    上传生成的图片带长期immutable缓存头，并以文件名（由内容哈希生成）作为ETag；
+    条件请求和Range请求由send_from_directory处理，文件内容交给WSGI服务器的
+    file_wrapper以sendfile发送，配置USE_X_SENDFILE后由前端Web服务器直接发送。
+
+    Args:
+        relative_path: 图片相对上传目录的路径
+
+    Returns:
+        Response: 图片响应
+    """
+    parts = relative_path.split('/')
+    # 暂存目录和处理中的临时文件不对外提供
+    if parts[0] == 'staging' or any(part.startswith('.') for part in parts):
+        abort(404)
+    filename = parts[-1]
+    if not IMMUTABLE_NAME_RE.match(filename):
+        return send_from_directory(image_pipeline.upload_folder, relative_path)
+    response = send_from_directory(
+        image_pipeline.upload_folder, relative_path,
+        etag=filename,
+        max_age=current_app.config['UPLOAD_CACHE_MAX_AGE']
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -1,13 +1,24 @@
-import os
-import secrets
-from PIL import Image
-from flask import current_app
+import json
+import math
+import time
+import base64
+from datetime import datetime
+
+from flask import current_app, url_for
+from markupsafe import Markup
+from sqlalchemy import and_, or_
+
+from .image_pipeline import image_pipeline, variant_path
+from .uploads import retain_picture
 
 
 def save_picture(form_picture, is_avatar=False):
     """
     保存上传的图片到服务器
     
+    图片按内容哈希命名，相同的图片只保存一份；原图写入暂存目录后立即返回文件名，
+    缩放和重新编码由后台图片处理管道完成。返回的图片已计入一次引用。
+    
     Args:
         form_picture: Flask-WTF文件字段对象
         is_avatar: 是否为头像图片
@@ -16,44 +27,68 @@ def save_picture(form_picture, is_avatar=False):
         str: 保存后的图片文件名
     """
     try:
-        # 生成随机文件名
-        random_hex = secrets.token_hex(8)
-        _, f_ext = os.path.splitext(form_picture.filename)
-        picture_fn = random_hex + f_ext
-        
-        # 确保上传主目录存在
-        if not os.path.exists(current_app.config['UPLOAD_FOLDER']):
-            os.makedirs(current_app.config['UPLOAD_FOLDER'])
-        
-        if is_avatar:
-            # 确保avatars子目录存在
-            avatars_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'avatars')
-            if not os.path.exists(avatars_folder):
-                os.makedirs(avatars_folder)
-            picture_path = os.path.join(avatars_folder, picture_fn)
-            # 头像图片保持125x125像素
-            output_size = (125, 125)
-        else:
-            picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], picture_fn)
-            # 商品图片使用更大的尺寸，保持宽高比
-            output_size = (800, 800)
-        
-        # 调整图片大小
-        i = Image.open(form_picture)
-        i.thumbnail(output_size)
-        # 保存图片，对于JPEG格式设置质量参数
-        if f_ext.lower() in ['.jpg', '.jpeg']:
-            i.save(picture_path, quality=85, optimize=True)
-        else:
-            i.save(picture_path)
-        
-        return picture_fn
+        # 头像保存在avatars子目录
+        # 先登记引用再检查文件是否存在，避免复用正在被垃圾回收删除的图片
+        relative_path = image_pipeline.store(
+            form_picture, 'avatars' if is_avatar else '',
+            retain=lambda path: retain_picture(path.rsplit('/', 1)[-1], is_avatar)
+        )
+        return relative_path.rsplit('/', 1)[-1]
     except Exception as e:
         # 记录错误并返回默认图片
         print(f"Error saving picture: {e}")
         return 'default_avatar.png' if is_avatar else 'default.jpg'
 
 
+def upload_url(filename, is_avatar=False, size=None, webp=False):
+    """
+    获取上传图片的URL，供模板使用
+    
+    按页面需要的尺寸选择对应版本；图片仍在后台处理或处理失败时返回默认图片的URL。
+    返回结果与请求头无关，渲染结果可以被共享缓存，WebP由浏览器通过webp_source选择。
+    
+    Args:
+        filename: 图片文件名
+        is_avatar: 是否为头像图片
+        size: 尺寸版本，thumb为列表缩略图，full为原尺寸大图，默认为详情页主图
+        webp: 是否返回WebP版本
+        
+    Returns:
+        str: 图片URL；webp为True且尚未生成WebP版本时返回None
+    """
+    folder = 'avatars/' if is_avatar else ''
+    relative_path = folder + filename
+    if not image_pipeline.is_ready(relative_path):
+        relative_path = folder + ('default_avatar.png' if is_avatar else 'default.jpg')
+    candidate = variant_path(relative_path, size, webp=webp)
+    if candidate != relative_path and not image_pipeline.is_ready(candidate):
+        if webp:
+            return None
+        # 尚未生成该版本的旧图片直接使用主图
+        candidate = relative_path
+    return url_for('main.uploaded_file', filename=candidate)
+
+
+def webp_source(filename, is_avatar=False, size=None):
+    """
+    生成<picture>中的WebP候选，供模板使用
+    
+    模板以<picture>{{ webp_source(...) }}<img src="{{ upload_url(...) }}"></picture>
+    输出图片，支持WebP的浏览器使用WebP版本，其余浏览器使用<img>中的原格式。
+    
+    Args:
+        filename: 图片文件名
+        is_avatar: 是否为头像图片
+        size: 尺寸版本，与upload_url相同
+        
+    Returns:
+        Markup: <source>标签；尚未生成WebP版本时为空
+    """
+    url = upload_url(filename, is_avatar, size, webp=True)
+    if url is None:
+        return Markup('')
+    return Markup('<source type="image/webp" srcset="{}">').format(url)
+
 
 def format_content(content):
     """
@@ -89,3 +124,184 @@ def get_pagination_data(query, page, per_page=10):
     """
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
     return pagination, pagination.items
+
+
+class CursorPagination:
+    """
+    游标分页结果
+    
+    只记录上一页和下一页的链接参数，模板中用
+    url_for(..., **pagination.next_args)生成翻页链接。
+    
+    Attributes:
+        items: 当前页数据列表
+        next_args: 下一页的查询参数，没有下一页时为None
+        prev_args: 上一页的查询参数，没有上一页时为None
+        total: 近似总数，未统计时为None
+    """
+    
+    def __init__(self, items, next_args=None, prev_args=None, total=None):
+        self.items = items
+        self.next_args = next_args
+        self.prev_args = prev_args
+        self.total = total
+    
+    @property
+    def has_next(self):
+        return self.next_args is not None
+    
+    @property
+    def has_prev(self):
+        return self.prev_args is not None
+    
+    @property
+    def next_cursor(self):
+        return (self.next_args or {}).get('after')
+
+
+def encode_cursor(values):
+    """将排序列的值编码为URL安全的游标字符串"""
+    data = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    """
+    解析游标字符串，格式不正确时返回None
+    
+    Args:
+        cursor: 游标字符串
+        keys: 排序列列表，用于还原各值的类型
+        
+    Returns:
+        list: 排序列的值
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data, list) or len(data) != len(keys):
+            return None
+        return [_cursor_value(column.type.python_type, v) for (column, _), v in zip(keys, data)]
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def _cursor_value(python_type, value):
+    """按排序列的类型还原游标中的值，类型不符时抛出TypeError，避免构造的游标导致数据库类型转换错误"""
+    if value is None:
+        return None
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is float and type(value) in (int, float) and math.isfinite(value):
+        return float(value)
+    if type(value) is python_type:
+        return value
+    raise TypeError(f'游标值类型不符: {value!r}')
+
+
+def _keyset_condition(keys, values, reverse):
+    """生成位于游标之后（reverse为True时为之前）的过滤条件"""
+    conditions = []
+    for i, (column, descending) in enumerate(keys):
+        forward = column < values[i] if descending else column > values[i]
+        backward = column > values[i] if descending else column < values[i]
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        conditions.append(and_(*equal, backward if reverse else forward))
+    return or_(*conditions)
+
+
+def get_keyset_page(query, keys, after=None, before=None, per_page=10, count_key=None):
+    """
+    按游标获取分页数据
+    
+    以(排序列, id)作为游标定位，不使用OFFSET，也不统计总数，
+    因此任意一页的查询开销都与第一页相同。
+    
+    Args:
+        query: 未排序的SQLAlchemy查询对象
+        keys: [(列, 是否降序)]，最后一列必须唯一（通常是id）
+        after: 下一页游标，取该位置之后的数据
+        before: 上一页游标，取该位置之前的数据
+        per_page: 每页数据量
+        count_key: 需要近似总数时传入缓存键，总数缓存PAGINATION_COUNT_TTL秒
+        
+    Returns:
+        CursorPagination: 分页结果
+    """
+    total = cached_count(count_key, query) if count_key is not None else None
+    reverse = bool(before) and not after
+    values = decode_cursor(before if reverse else after, keys) if (after or before) else None
+    if values is not None:
+        query = query.filter(_keyset_condition(keys, values, reverse))
+    else:
+        reverse = False
+    # 向前翻页时反向排序取数据，再把结果翻转回正常顺序
+    query = query.order_by(*[column.desc() if descending != reverse else column.asc()
+                             for column, descending in keys])
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+    
+    def cursor_of(row):
+        return encode_cursor([getattr(row, column.key) for column, _ in keys])
+    
+    next_args = prev_args = None
+    if rows:
+        if more or reverse:
+            next_args = {'after': cursor_of(rows[-1])}
+        if (more and reverse) or (values is not None and not reverse):
+            prev_args = {'before': cursor_of(rows[0])}
+    return CursorPagination(rows, next_args, prev_args, total)
+
+
+def get_offset_page(query, page, per_page=10, count_key=None):
+    """
+    按页码获取分页数据，用于无法按列定位的排序（如搜索相关度）
+    
+    与get_keyset_page返回相同的分页结果对象，只取多一条判断是否有下一页，
+    不统计总数。
+    
+    Args:
+        query: 已排序的SQLAlchemy查询对象
+        page: 当前页码
+        per_page: 每页数据量
+        count_key: 需要近似总数时传入缓存键
+        
+    Returns:
+        CursorPagination: 分页结果
+    """
+    total = cached_count(count_key, query) if count_key is not None else None
+    page = max(page, 1)
+    rows = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    next_args = {'page': page + 1} if len(rows) > per_page else None
+    prev_args = {'page': page - 1} if page > 1 else None
+    return CursorPagination(rows[:per_page], next_args, prev_args, total)
+
+
+# 近似总数缓存：{缓存键: (过期时间, 总数)}
+_count_cache = {}
+
+
+def cached_count(key, query):
+    """
+    获取查询结果的近似总数，结果在进程内缓存PAGINATION_COUNT_TTL秒
+    
+    Args:
+        key: 缓存键，需包含所有影响结果的过滤参数
+        query: SQLAlchemy查询对象
+        
+    Returns:
+        int: 总数
+    """
+    now = time.monotonic()
+    cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    total = query.order_by(None).count()
+    # 搜索词等参数组合过多时整体清空，避免缓存无限增长
+    if len(_count_cache) >= 1000:
+        _count_cache.clear()
+    _count_cache[key] = (now + current_app.config.get('PAGINATION_COUNT_TTL', 60), total)
+    return total
+
@@ -0,0 +1,139 @@
+import atexit
+import threading
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from .models import db, Item, User
+from .counters import HOTNESS_VIEW_WEIGHT
+
+
+class ViewCounter:
+    """
+    浏览量写缓冲区
+
+    商品详情页和用户主页的访问只在内存中累加浏览量，由后台线程每隔
+    VIEW_FLUSH_INTERVAL秒（或累计VIEW_FLUSH_THRESHOLD次访问后）合并成
+    批量UPDATE写入数据库，进程退出时再写入一次剩余的增量。
+    同一进程中有多个应用（测试、基准脚本）时按应用分别缓冲，各自写入自己的数据库。
+    """
+
+    def __init__(self, app=None):
+        self.interval = 5
+        self.threshold = 100
+        self._lock = threading.Lock()
+        # 应用 -> (商品浏览增量, 用户主页浏览增量)
+        self._buffers = {}
+        self._pending = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        绑定应用，第一次调用时注册退出时的写入并启动后台刷新线程
+
+        刷新间隔和阈值取自第一个应用的配置，之后的应用只登记自己的缓冲区，
+        不再重复注册atexit或启动线程。
+
+        Args:
+            app: Flask应用实例
+        """
+        app.extensions['view_counter'] = self
+        with self._lock:
+            self._buffers.setdefault(app, (Counter(), Counter()))
+            if self._registered:
+                return
+            self._registered = True
+            self.interval = app.config.get('VIEW_FLUSH_INTERVAL', 5)
+            self.threshold = app.config.get('VIEW_FLUSH_THRESHOLD', 100)
+        atexit.register(self.flush)
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='view-counter-flusher', daemon=True)
+            self._thread.start()
+
+    def record_item(self, item_id):
+        """记录一次商品浏览"""
+        self._record(0, item_id)
+
+    def record_user(self, user_id):
+        """记录一次用户主页浏览"""
+        self._record(1, user_id)
+
+    def _record(self, kind, key):
+        app = current_app._get_current_object()
+        with self._lock:
+            self._buffers.setdefault(app, (Counter(), Counter()))[kind][key] += 1
+            self._pending += 1
+            full = self._pending >= self.threshold
+        if full:
+            self._wakeup.set()
+
+    def _drain(self):
+        with self._lock:
+            drained = {app: buffers for app, buffers in self._buffers.items() if any(buffers)}
+            for app in drained:
+                self._buffers[app] = (Counter(), Counter())
+            self._pending = 0
+        return drained
+
+    def _restore(self, app, items, users):
+        with self._lock:
+            buffered_items, buffered_users = self._buffers.setdefault(app, (Counter(), Counter()))
+            buffered_items.update(items)
+            buffered_users.update(users)
+            self._pending += sum(items.values()) + sum(users.values())
+
+    def flush(self):
+        """
+        将各应用缓冲的浏览量增量批量写入各自的数据库
+
+        Returns:
+            int: 写入的浏览次数
+        """
+        written = 0
+        for app, (items, users) in self._drain().items():
+            if self._write(app, items, users):
+                written += sum(items.values()) + sum(users.values())
+        return written
+
+    def _write(self, app, items, users):
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                # 按ID顺序更新，减少并发刷新时的死锁概率
+                if items:
+                    item_table = Item.__table__
+                    conn.execute(
+                        item_table.update()
+                        .where(item_table.c.id == bindparam('b_id'))
+                        .values(views=item_table.c.views + bindparam('delta'),
+                                hotness=item_table.c.hotness + bindparam('delta') * HOTNESS_VIEW_WEIGHT),
+                        [{'b_id': item_id, 'delta': delta} for item_id, delta in sorted(items.items())]
+                    )
+                if users:
+                    user_table = User.__table__
+                    conn.execute(
+                        user_table.update()
+                        .where(user_table.c.id == bindparam('b_id'))
+                        .values(views=user_table.c.views + bindparam('delta')),
+                        [{'b_id': user_id, 'delta': delta} for user_id, delta in sorted(users.items())]
+                    )
+        except Exception as e:
+            # 写入失败时把增量放回缓冲区，等待下次刷新重试
+            self._restore(app, items, users)
+            print(f"浏览量写入失败: {e}")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+# 全局浏览量缓冲区，由app/__init__.py统一初始化
+view_counter = ViewCounter()
@@ -0,0 +1,187 @@
+"""
+复合索引前后查询计划对比
+
+在一个独立的测试数据库中生成模拟数据，分别在删除和创建复合索引的情况下，
+对routes.py中主要查询的执行计划和耗时进行对比。
+
+用法（会删除并重建目标库中的所有表，切勿指向正式数据库）：
+    BENCH_DATABASE_URL='mssql+pyodbc://localhost/CampusMarketBench?driver=ODBC+Driver+17+for+SQL+Server&Trusted_Connection=yes' \
+        python benchmarks/index_plans.py
+"""
+import os
+import re
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from app import create_app
+from app.models import (db, User, Item, Follow, Post, Like, UserFollow, Reply,
+                        Message, Notification, Stock, Comment)
+
+USERS = int(os.environ.get('BENCH_USERS', 500))
+ROWS = int(os.environ.get('BENCH_ROWS', 20000))
+RUNS = int(os.environ.get('BENCH_RUNS', 20))
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL')
+    VIEW_FLUSH_INTERVAL = 0
+
+
+def composite_indexes():
+    """返回模型中声明的所有多列索引"""
+    return [index for table in db.metadata.sorted_tables
+            for index in table.indexes if len(index.columns) > 1]
+
+
+def seed():
+    """生成模拟数据"""
+    now = datetime.utcnow()
+    rnd = random.Random(42)
+
+    def when():
+        return now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365))
+
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password': 'x', 'contact': 'x'}
+        for i in range(1, USERS + 1)
+    ])
+    db.session.bulk_insert_mappings(Item, [
+        {'id': i, 'title': f'item{i}', 'price': rnd.uniform(1, 500), 'description': 'bench',
+         'user_id': rnd.randint(1, USERS), 'date_posted': when()}
+        for i in range(1, ROWS // 4 + 1)
+    ])
+    pairs = {(rnd.randint(1, USERS), rnd.randint(1, ROWS // 4)) for _ in range(ROWS)}
+    db.session.bulk_insert_mappings(Follow, [
+        {'user_id': u, 'item_id': i, 'date_followed': when()} for u, i in pairs
+    ])
+    db.session.bulk_insert_mappings(Post, [
+        {'id': i, 'content': 'bench', 'user_id': rnd.randint(1, USERS), 'date_posted': when()}
+        for i in range(1, ROWS // 4 + 1)
+    ])
+    pairs = {(rnd.randint(1, USERS), rnd.randint(1, ROWS // 4)) for _ in range(ROWS)}
+    db.session.bulk_insert_mappings(Like, [{'user_id': u, 'post_id': p} for u, p in pairs])
+    db.session.bulk_insert_mappings(Reply, [
+        {'content': 'bench', 'user_id': rnd.randint(1, USERS), 'post_id': rnd.randint(1, ROWS // 4), 'date_posted': when()}
+        for _ in range(ROWS)
+    ])
+    pairs = {(rnd.randint(1, USERS), rnd.randint(1, USERS)) for _ in range(ROWS // 4)}
+    db.session.bulk_insert_mappings(UserFollow, [
+        {'follower_id': a, 'followed_id': b} for a, b in pairs if a != b
+    ])
+    db.session.bulk_insert_mappings(Message, [
+        {'sender_id': rnd.randint(1, USERS), 'receiver_id': rnd.randint(1, USERS), 'content': 'bench',
+         'date_sent': when(), 'is_read': rnd.random() < 0.8}
+        for _ in range(ROWS * 2)
+    ])
+    db.session.bulk_insert_mappings(Notification, [
+        {'user_id': rnd.randint(1, USERS), 'sender_id': rnd.randint(1, USERS), 'notification_type': 'like_post',
+         'content': 'bench', 'date_created': when(), 'is_read': rnd.random() < 0.8}
+        for _ in range(ROWS * 2)
+    ])
+    db.session.bulk_insert_mappings(Stock, [
+        {'name': f'stock{i % 200}', 'user_id': rnd.randint(1, USERS), 'date_added': when()}
+        for i in range(ROWS // 4)
+    ])
+    db.session.bulk_insert_mappings(Comment, [
+        {'content': 'bench', 'user_id': rnd.randint(1, USERS), 'item_id': rnd.randint(1, ROWS // 4), 'date_posted': when()}
+        for _ in range(ROWS)
+    ])
+    db.session.commit()
+
+
+def route_queries():
+    """routes.py中各路由的典型查询"""
+    me, other, item_id, post_id = 7, 11, 13, 17
+    return {
+        'profile: 用户商品': Item.query.filter_by(user_id=me).order_by(Item.date_posted.desc()),
+        'profile: 关注的商品': Item.query.join(Follow).filter(Follow.user_id == me).order_by(Follow.date_followed.desc()),
+        'follow_item: 关注状态': Follow.query.filter_by(user_id=me, item_id=item_id),
+        'like_post: 点赞状态': Like.query.filter_by(user_id=me, post_id=post_id),
+        'follow_user: 关注状态': UserFollow.query.filter_by(follower_id=me, followed_id=other),
+        'square: 帖子回复': Reply.query.filter_by(post_id=post_id).order_by(Reply.date_posted.asc()),
+        'messages: 聊天记录': Message.query.filter(
+            ((Message.sender_id == me) & (Message.receiver_id == other)) |
+            ((Message.sender_id == other) & (Message.receiver_id == me))
+        ).order_by(Message.date_sent.desc()).limit(20),
+        'messages: 会话未读数': Message.query.filter_by(receiver_id=me, sender_id=other, is_read=False),
+        'badge: 未读消息数': Message.query.filter_by(receiver_id=me, is_read=False),
+        'badge: 未读通知数': Notification.query.filter_by(user_id=me, is_read=False),
+        'notifications: 通知列表': Notification.query.filter_by(user_id=me).order_by(Notification.date_created.desc()).limit(20),
+        'payment_success: 买家库存': Stock.query.filter_by(user_id=me, name='stock5'),
+        'item_detail: 商品评论': Comment.query.filter_by(item_id=item_id).order_by(Comment.date_posted.desc()),
+    }
+
+
+def compile_sql(query):
+    return str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def explain(sql):
+    """返回查询计划摘要：SQL Server为估算开销，其他数据库为计划文本"""
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'mssql':
+            conn.exec_driver_sql('SET SHOWPLAN_XML ON')
+            try:
+                plan = conn.exec_driver_sql(sql).scalar()
+            finally:
+                conn.exec_driver_sql('SET SHOWPLAN_XML OFF')
+            match = re.search(r'StatementSubTreeCost="([^"]+)"', plan)
+            return f'cost={float(match.group(1)):.4f}' if match else 'cost=?'
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+        return '; '.join(row[-1] for row in rows)
+
+
+def analyze():
+    """更新统计信息，使优化器能根据数据分布选择索引（SQL Server会自动维护）"""
+    if db.engine.dialect.name != 'mssql':
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+
+
+def measure(label):
+    print(f'\n==== {label} ====')
+    analyze()
+    results = {}
+    for name, query in route_queries().items():
+        sql = compile_sql(query)
+        plan = explain(sql)
+        with db.engine.connect() as conn:
+            start = time.perf_counter()
+            for _ in range(RUNS):
+                conn.exec_driver_sql(sql).fetchall()
+            elapsed = (time.perf_counter() - start) / RUNS * 1000
+        results[name] = elapsed
+        print(f'{name:<28} {elapsed:8.3f} ms  {plan}')
+    return results
+
+
+def main():
+    if not BenchConfig.SQLALCHEMY_DATABASE_URI:
+        sys.exit('请通过环境变量BENCH_DATABASE_URL指定一个独立的测试数据库')
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed()
+        with db.engine.begin() as conn:
+            for index in composite_indexes():
+                index.drop(conn)
+        before = measure('仅单列索引')
+        with db.engine.begin() as conn:
+            for index in composite_indexes():
+                index.create(conn)
+        after = measure('加入复合索引')
+        print('\n==== 对比 ====')
+        for name in before:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            print(f'{name:<28} {before[name]:8.3f} ms -> {after[name]:8.3f} ms  x{speedup:.1f}')
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
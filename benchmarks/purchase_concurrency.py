@@ -0,0 +1,134 @@
+"""
+并发购买同一商品的压力测试
+
+在一个独立的测试数据库中准备一个库存有限的商品，由多个线程同时购买，
+检查是否超卖，并报告吞吐量和死锁重试后仍失败的次数。
+BENCH_MODE=legacy时改用旧的"读出库存-修改-写回"方式，用于对比。
+
+用法（会删除并重建目标库中的所有表，切勿指向正式数据库）：
+    BENCH_DATABASE_URL='mssql+pyodbc://localhost/CampusMarketBench?driver=ODBC+Driver+17+for+SQL+Server&Trusted_Connection=yes' \
+        python benchmarks/purchase_concurrency.py
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from app import create_app
+from app.models import db, User, Item, Stock
+from app.purchases import purchase_item, PurchaseError
+
+BUYERS = int(os.environ.get('BENCH_BUYERS', 16))
+STOCK = int(os.environ.get('BENCH_STOCK', 500))
+MODE = os.environ.get('BENCH_MODE', 'atomic')
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL')
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': BUYERS + 2, 'max_overflow': 0}
+    VIEW_FLUSH_INTERVAL = 0
+    IMAGE_WORKERS = 0
+
+
+def seed():
+    """生成一个卖家、若干买家和一个库存为STOCK的商品"""
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password': 'x', 'contact': 'x'}
+        for i in range(1, BUYERS + 2)
+    ])
+    db.session.add(Item(id=1, title='bench', price=1, description='bench', stock=STOCK, user_id=1))
+    db.session.commit()
+
+
+def legacy_purchase(buyer, item_id, quantity):
+    """旧的购买流程：在应用中读出库存、修改后写回，并发时会丢失更新"""
+    item = Item.query.get(item_id)
+    if item.stock < quantity:
+        db.session.rollback()
+        raise PurchaseError('商品库存不足！')
+    item.stock -= quantity
+    item.sales_count += quantity
+    item.seller.sales_count += 1
+    existing_stock = Stock.query.filter_by(user_id=buyer.id, name=item.title).first()
+    if existing_stock:
+        existing_stock.quantity += quantity
+    else:
+        db.session.add(Stock(name=item.title, quantity=quantity, description=item.description,
+                             image_file=item.image_file, user_id=buyer.id))
+    db.session.commit()
+    return item
+
+
+def buyer_loop(app, buyer_id, purchase, results, timeline, start):
+    """单个买家线程：每次购买1件，直到库存不足"""
+    with app.app_context():
+        buyer = db.session.get(User, buyer_id)
+        while True:
+            try:
+                purchase(buyer, 1, 1)
+            except PurchaseError:
+                break
+            except Exception as e:
+                db.session.rollback()
+                results['error'] += 1
+                print(f'购买失败: {e}')
+                continue
+            results['success'] += 1
+            timeline.append(time.perf_counter() - start)
+        db.session.remove()
+
+
+def main():
+    if not BenchConfig.SQLALCHEMY_DATABASE_URI:
+        sys.exit('请通过环境变量BENCH_DATABASE_URL指定一个独立的测试数据库')
+    purchase = legacy_purchase if MODE == 'legacy' else purchase_item
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed()
+
+    results = Counter()
+    timeline = []
+    start = time.perf_counter()
+    threads = [threading.Thread(target=buyer_loop, args=(app, buyer_id, purchase, results, timeline, start))
+               for buyer_id in range(2, BUYERS + 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        item = db.session.get(Item, 1)
+        seller = db.session.get(User, 1)
+        bought = db.session.query(db.func.coalesce(db.func.sum(Stock.quantity), 0)).scalar()
+        print(f'\n==== {MODE}: {BUYERS}个买家并发购买，初始库存{STOCK} ====')
+        print(f'成功购买       {results["success"]}')
+        print(f'失败           {results["error"]}')
+        print(f'剩余库存       {item.stock}')
+        print(f'商品已售数量   {item.sales_count}')
+        print(f'卖家成交量     {seller.sales_count}')
+        print(f'买家库存合计   {bought}')
+        print(f'耗时           {elapsed:.2f} s，吞吐量 {results["success"] / elapsed:.1f} 次/秒')
+
+        # 按时间窗口统计吞吐量，观察锁竞争是否随时间恶化
+        window = max(elapsed / 10, 0.001)
+        buckets = Counter(int(t / window) for t in timeline)
+        for bucket in range(int(elapsed / window) + 1):
+            print(f'  {bucket * window:6.2f}s ~ {(bucket + 1) * window:6.2f}s  {buckets[bucket] / window:8.1f} 次/秒')
+
+        oversold = results['success'] + item.stock != STOCK or item.sales_count != results['success'] \
+            or seller.sales_count != results['success'] or bought != results['success']
+        print('结果: ' + ('库存或计数不一致（超卖或丢失更新）' if oversold else '库存与各计数一致'))
+        db.drop_all()
+    if oversold and MODE != 'legacy':
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
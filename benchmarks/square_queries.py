@@ -0,0 +1,111 @@
+"""
+交流广场查询数回归测试
+
+分别在只有1条帖子和有20条帖子（每条带回复、帖子点赞和回复点赞）的情况下
+渲染/square，用before_cursor_execute监听器统计渲染页面执行的SQL语句数，
+两次必须相同且不超过MAX_QUERIES，否则说明模板或路由重新出现了逐条查询。
+
+用法（会删除并重建目标库中的所有表，切勿指向正式数据库；未指定时使用内存SQLite）：
+    BENCH_DATABASE_URL='mssql+pyodbc://localhost/CampusMarketBench?driver=ODBC+Driver+17+for+SQL+Server&Trusted_Connection=yes' \
+        python benchmarks/square_queries.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from config import Config
+from app import create_app
+from app.models import db, User, Post, Like, Reply, ReplyLike
+
+USERS = 5
+REPLIES_PER_POST = 3
+# 渲染交流广场允许的最大语句数（用户加载、分页、点赞和回复的批量预取等）
+MAX_QUERIES = int(os.environ.get('BENCH_MAX_QUERIES', 10))
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL', 'sqlite://')
+    WTF_CSRF_ENABLED = False
+    VIEW_FLUSH_INTERVAL = 0
+    IMAGE_WORKERS = 0
+
+
+def seed_users():
+    """生成若干用户，密码均为password"""
+    password = generate_password_hash('password', method='pbkdf2:sha256')
+    db.session.add_all([
+        User(id=i, username=f'user{i}', email=f'user{i}@example.com', password=password, contact='x')
+        for i in range(1, USERS + 1)
+    ])
+    db.session.commit()
+
+
+def add_posts(count):
+    """补足count条帖子，每条帖子带回复（含引用）、帖子点赞和回复点赞"""
+    for n in range(Post.query.count(), count):
+        post = Post(content=f'post{n}', user_id=n % USERS + 1)
+        db.session.add(post)
+        db.session.flush()
+        previous = None
+        for r in range(REPLIES_PER_POST):
+            reply = Reply(content=f'reply{n}-{r}', user_id=r % USERS + 1, post_id=post.id,
+                          quoted_post_id=post.id if previous is None else None,
+                          quoted_reply_id=previous.id if previous else None)
+            db.session.add(reply)
+            db.session.flush()
+            db.session.add(ReplyLike(user_id=(r + 1) % USERS + 1, reply_id=reply.id))
+            previous = reply
+        for user_id in range(1, USERS + 1):
+            db.session.add(Like(user_id=user_id, post_id=post.id))
+    db.session.commit()
+
+
+def count_square_queries(app, client, posts):
+    """渲染一次交流广场，确认最新的帖子和回复已显示，返回执行的SQL语句数"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get('/square')
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200, response.status_code
+    page = response.get_data(as_text=True)
+    assert f'post{posts - 1}' in page and f'reply{posts - 1}-{REPLIES_PER_POST - 1}' in page
+    return len(statements)
+
+
+def main():
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_users()
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'user1@example.com', 'password': 'password'})
+    counts = {}
+    for posts in (1, 20):
+        with app.app_context():
+            add_posts(posts)
+        counts[posts] = count_square_queries(app, client, posts)
+        print(f'{posts:3d}条帖子: {counts[posts]}条SQL语句')
+
+    with app.app_context():
+        db.drop_all()
+    assert counts[1] == counts[20], f'查询数随帖子数增长: {counts}'
+    assert counts[20] <= MAX_QUERIES, f'查询数超过{MAX_QUERIES}: {counts[20]}'
+    print('结果: 查询数与帖子数无关')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,4 +13,52 @@ class Config:
     # 限制文件上传大小为16MB
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
     # 文件扩展名限制
-    ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+    # 排行榜展示条数，以及快照最长有效时间（秒），超过后在下次访问时重算
+    LEADERBOARD_SIZE = 10
+    LEADERBOARD_MAX_AGE = 300
+    # 浏览量批量写入间隔（秒）和触发提前写入的累计访问次数
+    VIEW_FLUSH_INTERVAL = 5
+    VIEW_FLUSH_THRESHOLD = 100
+    # 搜索后端：index为数据库内倒排索引，fulltext为SQL Server全文索引（需预先建立全文目录），like为LIKE模糊匹配
+    SEARCH_BACKEND = 'index'
+    # 图片处理线程数、最多排队的图片数（超出时在请求中同步处理）和失败重试次数
+    IMAGE_WORKERS = 2
+    IMAGE_QUEUE_SIZE = 32
+    IMAGE_MAX_RETRIES = 2
+    # 图片引用数降为0后保留的秒数，超过后才由gc-uploads删除
+    UPLOAD_GC_GRACE = 24 * 60 * 60
+    # 上传图片的浏览器缓存时间（秒），文件名由内容哈希生成，同名文件内容不会改变
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+    # 部署在Nginx/Apache后面时可开启，由Web服务器通过X-Sendfile直接发送图片
+    USE_X_SENDFILE = False
+    # 分页近似总数的缓存时间（秒）
+    PAGINATION_COUNT_TTL = 60
+    # 商品列表片段缓存：memory为进程内LRU，filesystem为同一服务器多进程共享的文件缓存，none为关闭
+    FRAGMENT_CACHE_BACKEND = 'memory'
+    FRAGMENT_CACHE_TTL = 60
+    FRAGMENT_CACHE_SIZE = 500
+    FRAGMENT_CACHE_DIR = None  # filesystem后端的目录，默认为instance/fragment_cache
+    # 通知批量写入间隔（秒），0为在业务事务中同步写入；点赞通知的合并窗口（秒）
+    NOTIFICATION_FLUSH_INTERVAL = 0
+    NOTIFICATION_COALESCE_WINDOW = 60 * 60
+    # 事件推送(/events/stream)：心跳间隔和单个连接的最长时间（秒），每个连接最多缓存的未读取事件数
+    EVENT_STREAM_HEARTBEAT = 15
+    EVENT_STREAM_MAX_DURATION = 300
+    EVENT_QUEUE_SIZE = 100
+    # 关注动态：粉丝数超过该值的用户发布内容时不写入粉丝时间线，改为读取时合并；
+    # 每个用户时间线保留的最大条数（由trim-timelines裁剪），关注用户时补入对方的最近内容条数
+    TIMELINE_FANOUT_LIMIT = 1000
+    TIMELINE_MAX_LENGTH = 500
+    TIMELINE_BACKFILL_SIZE = 20
+    # 商品推荐：每个商品保留的相似商品数；关注和购买超过该数量的用户不参与共现统计，
+    # 避免少数用户产生大量商品对；购买记录相对关注的权重
+    RECOMMENDATION_TOP_K = 10
+    RECOMMENDATION_MAX_USER_SIGNALS = 500
+    RECOMMENDATION_PURCHASE_WEIGHT = 2
+    # 求购匹配：商品售价最多可超出求购期望价格的比例；新发布内容标题中至少命中的词数；
+    # 每次发布最多通知的用户数；只匹配最近多少天内发布的求购
+    MATCH_PRICE_TOLERANCE = 0.2
+    MATCH_MIN_TOKENS = 2
+    MATCH_MAX_NOTIFICATIONS = 20
+    MATCH_REQUEST_MAX_AGE_DAYS = 30